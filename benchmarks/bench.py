@@ -0,0 +1,541 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks for zenbu.
+
+Generates a synthetic zenbu config from a seed, so that the same arguments
+always give the same tree:
+templates spread over directories, each extending a chain of layouts
+and including partials, variable sets of chained variables nested to a
+given depth, and a list of ignore patterns.
+
+Then times, through Zenbu's public methods:
+
+cold render:     building a Zenbu and writing every template to an empty
+                 destination, with no parsed YAML reused
+warm render:     refreshing the same Zenbu and rendering, with every
+                 destination already up to date
+diff:            diffing with a tenth of the destinations changed
+dry:             rendering without writing
+list cold:       listing variable sets without their index
+list warm:       listing variable sets with their index
+complete:        completing variable set names
+list cli:        running `zenbu -l` in a new process
+watch:           how long after a template is written its destination is
+
+The Python interpreter and the OS file cache are warm throughout, apart
+from `list cli`.
+
+Results are written as JSON with the arguments they were generated with,
+and any two results can be compared with --compare, which fails if any
+benchmark got slower by more than the threshold.
+"""
+
+from __future__ import print_function
+
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from time import time, sleep
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+ZENBU_SCRIPT = os.path.join(ROOT, 'zenbu.py')
+TEMPLATES_PER_DIR = 100
+DIFF_FRACTION = 10  # Change one in this many destinations for diff
+WATCH_TIMEOUT = 10  # Seconds to wait for a watched render
+WATCH_POLL = 0.002  # Seconds between checks for a watched render
+REGRESSION_THRESHOLD = 0.1  # Slowdown allowed by --compare
+BENCHMARKS = ('cold render', 'warm render', 'diff', 'dry', 'list cold',
+              'list warm', 'complete', 'list cli', 'watch')
+
+# Set by main() once the environment points at the generated config
+zenbu = None
+
+
+def generate(root, options):
+    """
+    Generate a zenbu config directory in root, returning its paths.
+    """
+    rng = random.Random(options.seed)
+    paths = {
+        'config': os.path.join(root, 'config'),
+        'zenbu': os.path.join(root, 'config', 'zenbu'),
+        'cache': os.path.join(root, 'cache'),
+        'dest': os.path.join(root, 'dest'),
+    }
+    paths['templates'] = os.path.join(paths['zenbu'], 'templates')
+    paths['var_sets'] = os.path.join(paths['zenbu'], 'variable_sets')
+    paths['defaults'] = os.path.join(paths['zenbu'], 'defaults.yaml')
+    paths['filters'] = os.path.join(paths['zenbu'], 'filters.py')
+    paths['ignores'] = os.path.join(paths['zenbu'], 'ignores.yaml')
+    for key in ('templates', 'var_sets', 'cache', 'dest'):
+        os.makedirs(paths[key])
+
+    def write(path, text):
+        parent = os.path.dirname(path)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        with open(path, 'w') as f:
+            f.write(text)
+
+    # Layouts, each extending the one before, and partials to include
+    layouts = os.path.join(paths['templates'], '_layouts')
+    for level in range(options.depth):
+        body = '{%% block body%d %%}{%% endblock %%}\n' % level
+        if level:
+            text = ('{%% extends "_layouts/level%d" %%}\n'
+                    '{%% block body%d %%}level %d\n%s{%% endblock %%}\n'
+                    % (level - 1, level - 1, level, body))
+        else:
+            text = 'level 0 for {{ name }}\n' + body
+        write(os.path.join(layouts, 'level%d' % level), text)
+    for partial in range(options.partials):
+        write(os.path.join(paths['templates'], '_partials', 'p%d' % partial),
+              '{%% for i in range(%d) %%}{{ colors.c%d.normal }} '
+              '{%% endfor %%}\n' % (partial % 5 + 1, partial % 16))
+
+    # Templates
+    for index in range(options.templates):
+        name = os.path.join('dir%04d' % (index // TEMPLATES_PER_DIR),
+                            't%06d' % index)
+        lines = ['# {{ name }} %d' % index,
+                 'font = {{ font }} {{ size }}',
+                 'fg = {{ colors.c%d.bold | upper }}' % rng.randrange(16)]
+        if options.partials:
+            lines.append('{%% include "_partials/p%d" %%}'
+                         % rng.randrange(options.partials))
+        if options.depth:
+            text = ('{%% extends "_layouts/level%d" %%}\n'
+                    '{%% block body%d %%}%s\n{%% endblock %%}\n'
+                    % (options.depth - 1, options.depth - 1,
+                       '\n'.join(lines)))
+        else:
+            text = '\n'.join(lines) + '\n'
+        write(os.path.join(paths['templates'], name), text)
+
+    # Variables: a palette, and sets of chained, nested variables
+    palette = ['colors:']
+    for color in range(16):
+        palette.append('  c%d:' % color)
+        palette.append('    normal: "#%06x"' % rng.randrange(1 << 24))
+        palette.append('    bold: "#%06x"' % rng.randrange(1 << 24))
+    write(paths['defaults'], '\n'.join(palette + [
+        'name: "bench"',
+        'font: "Monospace"',
+        'size: 12',
+        'primary: "{{ colors.c1.normal }}"',
+    ]) + '\n')
+
+    for var_set in range(options.var_files):
+        lines = ['size: %d' % rng.randrange(8, 20)]
+        for key in range(options.var_keys):
+            if key:
+                value = '"{{ v%d }}-%d"' % (key - 1, key)
+            else:
+                value = '"{{ primary }}"'
+            lines.append('v%d: %s' % (key, value))
+        for key in range(options.var_keys):
+            lines.append('n%d:' % key)
+            for level in range(1, options.nesting + 1):
+                lines.append('%sl%d:' % ('  ' * level, level))
+            lines.append('%sleaf: "{{ v%d }}"'
+                         % ('  ' * (options.nesting + 1), key))
+        write(os.path.join(paths['var_sets'], 'set%04d.yaml' % var_set),
+              '\n'.join(lines) + '\n')
+
+    # Filters, and ignores which mostly don't match
+    write(paths['filters'], 'def double(value):\n    return value * 2\n')
+    ignores = ["- '^_'"]
+    for pattern in range(options.ignores):
+        ignores.append("- '^nomatch%d.*$'" % pattern)
+    write(paths['ignores'], '\n'.join(ignores) + '\n')
+
+    return paths
+
+
+def build(paths, options, **kwargs):
+    """
+    Build a Zenbu for the generated config.
+    """
+    variables = [paths['defaults']]
+    if options.var_files:
+        variables.append('set0000')
+    return zenbu.Zenbu(paths['templates'], paths['dest'],
+                       var_set_path=paths['var_sets'],
+                       variables=variables,
+                       filters_path=paths['filters'],
+                       ignores_path=paths['ignores'],
+                       jobs=options.jobs,
+                       **kwargs)
+
+
+def reset_dest(paths):
+    shutil.rmtree(paths['dest'])
+    os.makedirs(paths['dest'])
+
+
+def time_runs(repeat, run, setup=None):
+    """
+    Time repeat runs of run, calling setup untimed before each.
+    """
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time()
+        run()
+        times.append(time() - start)
+    return times
+
+
+def bench_watch(paths, options):
+    """
+    Time from writing a template to its destination being written.
+    """
+    watched = build(paths, options, watch_quiet=options.watch_quiet)
+    watched.render_and_write()
+    template = os.path.join(paths['templates'], 'dir0000', 't000000')
+    dest = os.path.join(paths['dest'], 'dir0000', 't000000')
+    with open(template) as f:
+        source = f.read()
+
+    times = []
+    watched.watch()
+    sleep(0.5)  # Let the observer start
+    try:
+        for run in range(options.repeat):
+            marker = 'watch run %d' % run
+            start = time()
+            with open(template, 'w') as f:
+                f.write(source.replace('# {{ name }}', '# ' + marker))
+            while time() - start < WATCH_TIMEOUT:
+                try:
+                    with open(dest) as f:
+                        if marker in f.read():
+                            break
+                except IOError:
+                    pass
+                sleep(WATCH_POLL)
+            else:
+                raise RuntimeError("Watch did not render %s" % dest)
+            times.append(time() - start)
+    finally:
+        watched.stop_watch()
+        watched.join_watch()
+        with open(template, 'w') as f:
+            f.write(source)
+    return times
+
+
+def run_benchmarks(paths, options):
+    """
+    Run the selected benchmarks, returning name -> list of seconds.
+    """
+    results = {}
+    selected = [name for name in BENCHMARKS
+                if not options.only or name in options.only]
+    index_file = os.path.join(zenbu.ZENBU_CACHE, zenbu.VAR_SETS_INDEX_FILE)
+
+    def forget_yaml():
+        zenbu.yaml_cache = zenbu.YamlCache()
+        reset_dest(paths)
+
+    def cold():
+        build(paths, options).render_and_write()
+
+    if 'cold render' in selected:
+        results['cold render'] = time_runs(options.repeat, cold, forget_yaml)
+
+    warm = build(paths, options)
+    warm.render_and_write()
+
+    def warm_render():
+        warm.refresh()
+        warm.render_and_write()
+
+    def change_dests():
+        # Change the same destinations each time
+        for index, (_, dest) in enumerate(warm.render_pairs):
+            if index % DIFF_FRACTION == 0:
+                with open(dest, 'a') as f:
+                    f.write('changed\n')
+
+    def diff():
+        for lines in warm.diff():
+            for _ in lines:
+                pass
+
+    def dry():
+        for _ in warm.render():
+            pass
+
+    def list_var_sets():
+        zenbu.cached_var_sets(paths['var_sets'], paths['ignores'])
+
+    def forget_index():
+        if os.path.exists(index_file):
+            os.remove(index_file)
+
+    def complete():
+        zenbu.variable_set_completer('set')
+
+    def list_cli():
+        subprocess.check_call(
+            [sys.executable, ZENBU_SCRIPT, '-l', '--no-daemon'],
+            stdout=open(os.devnull, 'w'))
+
+    if 'warm render' in selected:
+        results['warm render'] = time_runs(options.repeat, warm_render)
+    if 'diff' in selected:
+        change_dests()
+        results['diff'] = time_runs(options.repeat, diff)
+        warm.render_and_write()
+    if 'dry' in selected:
+        results['dry'] = time_runs(options.repeat, dry)
+    if 'list cold' in selected:
+        results['list cold'] = time_runs(
+            options.repeat, list_var_sets, forget_index)
+    if 'list warm' in selected:
+        list_var_sets()
+        results['list warm'] = time_runs(options.repeat, list_var_sets)
+    if 'complete' in selected:
+        results['complete'] = time_runs(options.repeat, complete)
+    if 'list cli' in selected:
+        results['list cli'] = time_runs(options.repeat, list_cli)
+    if 'watch' in selected:
+        results['watch'] = bench_watch(paths, options)
+    return results
+
+
+def median(times):
+    times = sorted(times)
+    middle = len(times) // 2
+    if len(times) % 2:
+        return times[middle]
+    return (times[middle - 1] + times[middle]) / 2
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+            stderr=open(os.devnull, 'w')).decode('utf-8').strip()
+    except (IOError, OSError, subprocess.CalledProcessError):
+        return None
+
+
+def summarize(results, options):
+    """
+    Get the results as JSON-compatible data, in seconds.
+    """
+    return {
+        'revision': git_revision(),
+        'python': sys.version.split()[0],
+        'tree': dict((key, getattr(options, key)) for key in (
+            'templates', 'depth', 'partials', 'var_files', 'var_keys',
+            'nesting', 'ignores', 'seed', 'jobs', 'watch_quiet')),
+        'results': dict(
+            (name, {'min': min(times), 'median': median(times),
+                    'runs': times})
+            for name, times in results.items()),
+    }
+
+
+def report(summary):
+    print("%-12s %10s %10s" % ('Benchmark', 'Median ms', 'Min ms'))
+    for name in BENCHMARKS:
+        if name in summary['results']:
+            result = summary['results'][name]
+            print("%-12s %10.1f %10.1f"
+                  % (name, result['median'] * 1000, result['min'] * 1000))
+
+
+def compare(base_path, new_path, threshold):
+    """
+    Compare two results files, returning whether anything regressed.
+    """
+    with open(base_path) as f:
+        base = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+
+    if base['tree'] != new['tree']:
+        print("Warning: the results are for different trees", file=sys.stderr)
+
+    regressed = False
+    print("%-12s %10s %10s %8s" % ('Benchmark', base['revision'] or 'base',
+                                   new['revision'] or 'new', 'Change'))
+    for name in BENCHMARKS:
+        if name not in base['results'] or name not in new['results']:
+            continue
+        before = base['results'][name]['median']
+        after = new['results'][name]['median']
+        change = after / before - 1 if before else 0
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressed = True
+        print("%-12s %10.1f %10.1f %+7.1f%%%s"
+              % (name, before * 1000, after * 1000, change * 100, flag))
+    return regressed
+
+
+def parse_args():
+    parser = ArgumentParser(description=__doc__,
+                            formatter_class=RawDescriptionHelpFormatter)
+
+    parser.add_argument('--templates',
+                        help="number of templates. Default: 1000",
+                        type=int,
+                        default=1000)
+
+    parser.add_argument('--depth',
+                        help="""
+                        number of layouts each template extends through.
+                        Default: 3
+                        """,
+                        type=int,
+                        default=3)
+
+    parser.add_argument('--partials',
+                        help="number of partials to include. Default: 20",
+                        type=int,
+                        default=20)
+
+    parser.add_argument('--var-files',
+                        help="number of variable sets. Default: 10",
+                        type=int,
+                        default=10)
+
+    parser.add_argument('--var-keys',
+                        help="""
+                        number of chained variables per variable set.
+                        Default: 50
+                        """,
+                        type=int,
+                        default=50)
+
+    parser.add_argument('--nesting',
+                        help="how deeply variables nest. Default: 3",
+                        type=int,
+                        default=3)
+
+    parser.add_argument('--ignores',
+                        help="number of ignore patterns. Default: 20",
+                        type=int,
+                        default=20)
+
+    parser.add_argument('--seed',
+                        help="seed for generating the tree. Default: 0",
+                        type=int,
+                        default=0)
+
+    parser.add_argument('--repeat',
+                        help="runs of each benchmark. Default: 5",
+                        type=int,
+                        default=5)
+
+    parser.add_argument('-j', '--jobs',
+                        help="processes to render with. Default: 1",
+                        type=int,
+                        default=1)
+
+    parser.add_argument('--watch-quiet',
+                        help="""
+                        quiet period for the watch benchmark, in seconds.
+                        Default: 0.05
+                        """,
+                        type=float,
+                        default=0.05)
+
+    parser.add_argument('--only',
+                        help="""
+                        benchmarks to run, comma-separated.
+                        Default: all of them
+                        """,
+                        type=lambda s: s.split(','),
+                        default=None)
+
+    parser.add_argument('-o', '--output',
+                        help="JSON file to write the results to",
+                        type=str,
+                        default=None)
+
+    parser.add_argument('--keep',
+                        help="directory to generate into and keep",
+                        type=str,
+                        default=None)
+
+    parser.add_argument('--compare',
+                        help="""
+                        compare two results files instead, failing if
+                        anything got slower than the threshold
+                        """,
+                        nargs=2,
+                        metavar=('BASE', 'NEW'),
+                        default=None)
+
+    parser.add_argument('--threshold',
+                        help="""
+                        slowdown allowed by --compare, as a fraction.
+                        Default: %s
+                        """ % REGRESSION_THRESHOLD,
+                        type=float,
+                        default=REGRESSION_THRESHOLD)
+
+    return parser.parse_args()
+
+
+def main():
+    global zenbu
+    options = parse_args()
+
+    # --compare
+    if options.compare:
+        sys.exit(1 if compare(options.compare[0], options.compare[1],
+                              options.threshold) else 0)
+
+    if options.only:
+        unknown = set(options.only) - set(BENCHMARKS)
+        if unknown:
+            sys.exit("Unknown benchmarks: %s" % ', '.join(sorted(unknown)))
+
+    if options.keep:
+        root = os.path.abspath(options.keep)
+        if os.path.exists(root):
+            sys.exit("%s already exists" % root)
+        os.makedirs(root)
+    else:
+        root = tempfile.mkdtemp(prefix='zenbu-bench-')
+
+    try:
+        paths = generate(root, options)
+
+        # zenbu reads its default paths when imported,
+        # and the -l benchmarks need the defaults
+        os.environ['XDG_CONFIG_HOME'] = paths['config']
+        os.environ['XDG_CACHE_HOME'] = paths['cache']
+        sys.path.insert(0, ROOT)
+        import zenbu
+        zenbu.logger.disabled = True
+
+        summary = summarize(run_benchmarks(paths, options), options)
+    finally:
+        if not options.keep:
+            shutil.rmtree(root)
+
+    report(summary)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -13,12 +13,20 @@ an optional python file with filters in (by default)
 
 an optional yaml file with an ignore scalar of regexes in (by default)
 ~/.config/zenbu/ignores.yaml,
+which are matched against both names and relative paths, skipping
+ignored directories entirely,
 
 and uses the Jinja2 templates in (by default)
 ~/.config/zenbu/templates/
 
 to render into your home directory (by default).
 
+Binary files, and files without any Jinja2 syntax, are copied as they
+are instead, or linked via the --link flag: cloned copy-on-write where
+the filesystem supports it, or else hard linked, which makes the
+destination the same file as the template, so that editing either in
+place edits both.
+
 Additional variable files can be applied
 by supplying them as arguments, in order of application.
 
@@ -37,8 +45,9 @@ last YAML variable defined >
 first YAML variable defined >
 environment variables.
 
-Variables are shallowly resolved once. Thus, for example you may have the
-following in your defaults.yaml for convenience:
+Variables may use other variables, which are resolved first, however
+deeply they chain (but not in cycles). Thus, for example you may have
+the following in your defaults.yaml for convenience:
 
 n_primary:  "{{ colors[colors.primary].normal }}"
 
@@ -50,9 +59,42 @@ Whenever a variable file in use, the filters file, the ignores file,
 or a template file changes, the templates are rendered
 if there are any differences. This can be overridden with a custom list of
 directories via the --watch-dirs flag.
+Rendering waits until changes stop for a quiet period (--watch-quiet),
+or until they have been waiting too long (--watch-max-latency).
+When only template files or variable files change, just the changed
+templates, the templates using changed variables, and the templates
+that include, extend or import those are rendered again.
 
 Diffs between the current destination files and
 template renderings are available via the --diff flag.
+For scripts, --check lists the destination files which differ and
+--diff-stat counts their changed lines; both exit with status 1
+if any differ, or 2 if any template could not be rendered.
+
+Compiled templates and parsed YAML files can be cached across runs in
+(by default)
+~/.cache/zenbu/
+via the --cache flag.
+
+A daemon started via the --daemon flag keeps templates and
+variables loaded; other commands run in it when it is listening on
+$XDG_RUNTIME_DIR/zenbu-$UID.sock (or /tmp/zenbu-$UID/zenbu-$UID.sock),
+unless run with the --no-daemon flag. File watching always runs
+in its own process.
+
+Many destinations can be rendered in one run via the --batch flag,
+given a YAML manifest listing a dest directory and its variables
+(variable files or variable set names) for each, e.g.
+
+- dest: ~/hosts/laptop
+  variables: [laptop, dark]
+
+Relative paths are relative to the manifest. Templates are compiled
+only once for the whole batch.
+
+Where the time goes, per phase of work and for the slowest files,
+is reported via the --profile flag, or written as JSON via the
+--profile-json flag.
 
 For help on designing templates, refer to
 http://jinja.pocoo.org/docs/dev/templates/
@@ -61,34 +103,41 @@ For help on creating filters, refer to
 http://jinja.pocoo.org/docs/dev/api/#custom-filters
 """
 
+from time import time
+START_TIME = time()  # For --startup-report
+
 import logging
 import os
 import sys
 import codecs
-import yaml
+import json
 import re
-import argcomplete
-import traceback
 from importlib import import_module
-from shutil import copystat
-from subprocess import call, check_output
-from threading import Timer
+from contextlib import contextmanager
 from time import sleep
-from difflib import unified_diff
-from pydoc import pipepager  # Dangerously undocumented...
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
-from termcolor import colored
-from colorlog import ColoredFormatter
-from jinja2 import Environment, FileSystemLoader, StrictUndefined, \
-     UndefinedError, TemplateSyntaxError, TemplateNotFound
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
+
+# Heavier modules are imported by the code paths that use them,
+# so that completion and -l start quickly.
 
 try:
     from collections.abc import Mapping
 except ImportError:
     from collections import Mapping
 
+try:
+    from importlib import reload
+except ImportError:
+    pass  # Python 2's is built in
+
+try:
+    from time import thread_time as cpu_time
+except ImportError:
+    try:
+        from time import process_time as cpu_time
+    except ImportError:
+        from time import clock as cpu_time  # Python 2
+
 # Constants
 HOME = os.getenv('HOME')
 CONFIG_DIR = os.getenv(
@@ -106,8 +155,31 @@ ZENBU_IGNORES = os.path.join(
     ZENBU_ROOT, 'ignores.yaml')
 ZENBU_TEMPLATES = os.path.join(
     ZENBU_ROOT, 'templates')
+CACHE_DIR = os.getenv(
+    'XDG_CACHE_HOME',
+    os.path.join(HOME, '.cache'))
+ZENBU_CACHE = os.path.join(
+    CACHE_DIR, 'zenbu')
 TEMPLATE_EXT = 'yaml'
-WATCH_TIMEOUT = 0.5
+TEMPLATE_CACHE_SIZE = 400
+YAML_CACHE_FILE = 'yaml.pickle'
+VAR_SETS_INDEX_FILE = 'var_sets.json'
+STARTUP_BUDGET = 0.05  # Seconds
+HEAVY_MODULES = ('argcomplete', 'colorlog', 'difflib', 'jinja2',
+                 'multiprocessing', 'pydoc', 'termcolor', 'watchdog', 'yaml')
+HASH_CHUNK_SIZE = 1 << 16
+JOB_CHUNK_SIZE = 8
+WATCH_TIMEOUT = 0.5  # Quiet period, in seconds
+WATCH_MAX_LATENCY = 5.0  # Seconds
+WATCH_SKIP_EVENTS = ('opened', 'closed_no_write')  # Reads, not changes
+PROFILE_TOP = 20  # Slowest files to report
+WRITE_THREADS = 4
+WRITE_QUEUE_SIZE = 64  # Renders waiting to be written
+FICLONE = 0x40049409  # Linux ioctl to clone a file copy-on-write
+ZENBU_SOCKET = os.path.join(  # In a directory only we can write to
+    os.getenv('XDG_RUNTIME_DIR') or '/tmp/zenbu-{}'.format(os.getuid()),
+    'zenbu-{}.sock'.format(os.getuid()))
+DAEMON_INSTANCES = 8  # Warm Zenbus kept by the daemon
 
 # Logger
 logger = logging.getLogger(__name__)
@@ -117,46 +189,235 @@ logger.addHandler(logging.NullHandler())
 
 # Autocomplete
 def variable_set_completer(prefix, **kwargs):
-    # Use dummy template and dest directory
-    # TODO: make this less janky
-    DUMMY = '/tmp/'
     try:
-        var_sets = Zenbu(
-            DUMMY,
-            DUMMY,
-            ZENBU_VAR_SETS,
-            ignores_path=ZENBU_IGNORES,
-        ).var_sets
-    except NotFoundError as e:
-        # Try again with no ignores file
-        try:
-            var_sets = Zenbu(
-                DUMMY,
-                DUMMY,
-                ZENBU_VAR_SETS,
-            ).var_sets
-        except NotFoundError as e:
-            argcomplete.warn(e)
+        var_sets = cached_var_sets(ZENBU_VAR_SETS, ZENBU_IGNORES)
     except Exception as e:
+        import argcomplete
         argcomplete.warn(e)
     else:
         return (v for v in var_sets if v.startswith(prefix))
 
 
 def compgen_completer(prefix, **kwargs):
+    from subprocess import check_output
     out = check_output('compgen -A function -abck',
                        shell=True, universal_newlines=True)
     return (v for v in out.split() if v.startswith(prefix))
 
 
 # Convenience functions
-def make_dirs_and_open(path):
-    if not os.path.exists(os.path.dirname(path)):
-        os.makedirs(os.path.dirname(path))
-    return codecs.open(path, 'w', 'utf-8')
+def make_dirs(path):
+    if not os.path.exists(path):
+        try:
+            os.makedirs(path)
+        # Made by another thread meanwhile
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+
+
+def fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def hash_file(f):
+    import hashlib
+    digest = hashlib.sha1()
+    for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+        digest.update(chunk)
+    return digest.digest()
+
+
+def file_stamp(path):
+    # Returns what changes when a file is written to,
+    # or None if it doesn't exist
+    try:
+        stat = os.stat(path)
+    except (IOError, OSError, TypeError):
+        return None
+    return stat.st_mtime, stat.st_size
+
+
+def file_has(path, size, digest):
+    # Compare sizes first, so most changes need no reading
+    try:
+        if os.path.getsize(path) != size:
+            return False
+        with open(path, 'rb') as f:
+            return hash_file(f) == digest
+    except (IOError, OSError):
+        return False
+
+
+def file_matches(path, data):
+    import hashlib
+    return file_has(path, len(data), hashlib.sha1(data).digest())
+
+
+def files_match(path, other):
+    # Compare sizes first, so most changes need no reading
+    try:
+        if os.path.getsize(path) != os.path.getsize(other):
+            return False
+        with open(path, 'rb') as f, open(other, 'rb') as g:
+            return hash_file(f) == hash_file(g)
+    except (IOError, OSError):
+        return False
+
+
+def modes_match(path, other):
+    # Whether two files have the same permissions
+    try:
+        return os.stat(path).st_mode & 0o7777 == \
+            os.stat(other).st_mode & 0o7777
+    except (IOError, OSError):
+        return False
+
+
+def ensure_parent(path, dirs=None):
+    # dirs, if given, is a set of directories known to exist,
+    # which is kept up to date
+    parent = os.path.dirname(path)
+    if dirs is None or parent not in dirs:
+        make_dirs(parent)
+        if dirs is not None:
+            dirs.add(parent)
+
+
+def temp_beside(path):
+    # Makes a temporary file to rename over path, returning (fd, its path)
+    import tempfile
+    return tempfile.mkstemp(
+        dir=os.path.dirname(path),
+        prefix='.%s.' % os.path.basename(path),
+        suffix='.zenbu')
+
+
+def replace_atomically(path, fill, stat_path=None, dirs=None):
+    # Fills a file next to the destination, then renames it over it
+    from shutil import copystat
+
+    ensure_parent(path, dirs)
+    fd, tmp = temp_beside(path)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            fill(f)
+        if stat_path:
+            copystat(stat_path, tmp)
+        os.rename(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def write_atomically(path, data, stat_path=None, dirs=None):
+    replace_atomically(path, lambda f: f.write(data), stat_path, dirs)
+
+
+def copy_contents(src, dst):
+    # Copies between files within the kernel where it can,
+    # which may share the data on copy-on-write filesystems
+    from errno import EINVAL, ENOSYS, EXDEV, EOPNOTSUPP
+    from shutil import copyfileobj
+
+    size = os.fstat(src.fileno()).st_size
+    for method in ('copy_file_range', 'sendfile'):
+        copy = getattr(os, method, None)
+        if not copy:
+            continue
+        try:
+            offset = 0
+            while offset < size:
+                if method == 'copy_file_range':
+                    sent = copy(src.fileno(), dst.fileno(), size - offset,
+                                offset)
+                else:
+                    sent = copy(dst.fileno(), src.fileno(), offset,
+                                size - offset)
+                if not sent:  # Shrunk meanwhile
+                    break
+                offset += sent
+            return
+        except OSError as e:
+            if e.errno not in (EINVAL, ENOSYS, EXDEV, EOPNOTSUPP):
+                raise
+            # Start over
+            dst.seek(0)
+            dst.truncate()
+
+    src.seek(0)
+    copyfileobj(src, dst, HASH_CHUNK_SIZE)
+
+
+def copy_atomically(src, path, dirs=None):
+    with open(src, 'rb') as f:
+        replace_atomically(path, lambda g: copy_contents(f, g), src, dirs)
+
+
+def write_streaming(path, chunks, stat_path=None, dirs=None):
+    # Writes chunks of text next to the destination as they come, then
+    # renames them over it unless it already had them.
+    # Returns whether the destination was written.
+    import hashlib
+    from shutil import copystat
+
+    ensure_parent(path, dirs)
+    fd, tmp = temp_beside(path)
+    try:
+        digest = hashlib.sha1()
+        size = 0
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                data = chunk.encode('utf-8')
+                digest.update(data)
+                size += len(data)
+                f.write(data)
+        if file_has(path, size, digest.digest()) and \
+                (not stat_path or modes_match(path, stat_path)):
+            os.remove(tmp)
+            return False
+        if stat_path:
+            copystat(stat_path, tmp)
+        os.rename(tmp, path)
+        return True
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def reflink_atomically(src, path, dirs=None):
+    # Clones a file copy-on-write, where the filesystem supports it,
+    # raising OSError where it doesn't
+    try:
+        from fcntl import ioctl
+    except ImportError:
+        raise OSError("cloning files is not supported")
+    with open(src, 'rb') as f:
+        replace_atomically(
+            path, lambda g: ioctl(g.fileno(), FICLONE, f.fileno()), src, dirs)
+
+
+def link_atomically(src, path, dirs=None):
+    # Hard links, then renames the link over the destination
+    ensure_parent(path, dirs)
+    fd, tmp = temp_beside(path)
+    os.close(fd)
+    os.remove(tmp)
+    os.link(src, tmp)
+    try:
+        os.rename(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
 
 
 def diff_colorify(line):
+    from termcolor import colored
     if re.match(r'^(===|---|\+\+\+|@@)', line):
         return colored(line, attrs=['bold'])
     elif re.match(r'^\+', line):
@@ -169,6 +430,136 @@ def diff_colorify(line):
         return line
 
 
+def walk_files(root, ignored, dirs=None):
+    # Yields paths relative to root, following symlinks but without
+    # descending into ignored directories or symlink loops.
+    # Records the mtime of each directory walked in dirs.
+    pending = [('', frozenset())]  # (directory, its ancestors' inodes)
+    while pending:
+        short_path, ancestors = pending.pop()
+        path = os.path.join(root, short_path)
+        try:
+            st = os.stat(path)
+            entries = list(os.scandir(path))
+        except OSError:
+            continue
+
+        inode = (st.st_dev, st.st_ino)
+        if inode in ancestors:
+            continue
+        ancestors = ancestors | frozenset([inode])
+        if dirs is not None:
+            dirs[path] = st.st_mtime
+
+        subdirs = []
+        for entry in entries:
+            name = os.path.join(short_path, entry.name)
+            if ignored(name):
+                continue
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                subdirs.append((name, ancestors))
+            else:
+                yield name
+        pending.extend(reversed(subdirs))
+
+
+def scan_var_sets(var_set_path, ignored):
+    # Returns (names, mapping of each directory walked to its mtime)
+    dirs = {}
+    names = [os.path.splitext(path)[0]  # Without .yaml
+             for path in walk_files(var_set_path, ignored, dirs)]
+    return names, dirs
+
+
+def cached_var_sets(var_set_path, ignores_path):
+    # Lists variable sets without a Zenbu, reusing the last listing
+    # until a directory or the ignores file changes
+    index_file = os.path.join(ZENBU_CACHE, VAR_SETS_INDEX_FILE)
+    var_set_path = os.path.abspath(var_set_path)
+    ignores_mtime = os.stat(ignores_path).st_mtime \
+        if ignores_path and os.path.isfile(ignores_path) else None
+
+    try:
+        with open(index_file) as f:
+            index = json.load(f)
+        if index['path'] == var_set_path and \
+                index['ignores_mtime'] == ignores_mtime and \
+                all(os.stat(d).st_mtime == mtime
+                    for d, mtime in index['dirs'].items()):
+            return index['names']
+    # Missing, stale or corrupt
+    except Exception:
+        pass
+
+    ignores = IgnoreMatcher(load_ignore_patterns(ignores_path)
+                            if ignores_mtime is not None else [])
+    names, dirs = scan_var_sets(var_set_path, ignores.match)
+
+    # Without the root's mtime, nothing would tell when it appears
+    if os.path.join(var_set_path, '') not in dirs:
+        return names
+    try:
+        write_atomically(index_file, json.dumps({
+            'path': var_set_path,
+            'ignores_mtime': ignores_mtime,
+            'dirs': dirs,
+            'names': names,
+        }).encode('utf-8'))
+    except (IOError, OSError):
+        pass
+    return names
+
+
+def load_ignore_patterns(path):
+    try:
+        to_merge = yaml_cache.load(path)
+    except Exception as e:
+        raise ParseError(path, e)
+    if not isinstance(to_merge, list):
+        raise ParseError(path, "  (not in scalar format)")
+    for pattern in to_merge:
+        try:
+            re.compile(pattern)
+        except (re.error, TypeError) as e:
+            raise ParseError(path, "  (bad pattern %r: %s)" % (pattern, e))
+    return to_merge
+
+
+def load_batch(path):
+    # Reads a batch manifest into (variables, dest) jobs, resolving paths
+    # relative to the manifest
+    try:
+        entries = yaml_cache.load(path)
+    except (IOError, OSError):
+        raise NotFoundError(path, "batch manifest")
+    except Exception as e:
+        raise ParseError(path, e)
+    if not isinstance(entries, list):
+        raise ParseError(path, "  (not in scalar format)")
+
+    base = os.path.dirname(os.path.abspath(path))
+
+    def resolve(name):
+        return os.path.join(base, os.path.expanduser(name))
+
+    jobs = []
+    for entry in entries:
+        if not isinstance(entry, Mapping) or 'dest' not in entry:
+            raise ParseError(path, "  (job without a dest: %r)" % (entry,))
+        variables = entry.get('variables') or []
+        if not isinstance(variables, list):
+            variables = [variables]
+        # Like on the command line, names may be files or variable sets
+        variables = [resolve(name) if os.path.exists(resolve(name))
+                     else name for name in map(str, variables)]
+        jobs.append((variables, resolve(str(entry['dest']))))
+    return jobs
+
+
 def deep_update_dict(d, u):
     for k, v in u.items():
         if isinstance(d, Mapping):
@@ -214,9 +605,18 @@ class RenderError(PathException):
         return msg
 
 
+class WriteError(PathException):
+    def __str__(self):
+        msg = "Could not write: \"%s\"" % self.path
+        if self.message:
+            msg += "\n    (%s)" % self.message
+        return msg
+
+
 class VariableRenderError(Exception):
     def __init__(self, variable_name, message=None):
         super(VariableRenderError, self).__init__(message)
+        self.message = message
         self.variable_name = variable_name
 
     def __str__(self):
@@ -226,17 +626,608 @@ class VariableRenderError(Exception):
         return msg
 
 
-# Utility scope class
-class Scope(object):
-    pass
+class Debouncer(object):
+    """
+    Collects changed paths on one long-lived thread, and hands them to
+    a callback once none have arrived for a quiet period, or once the
+    first of them has waited for the maximum latency.
+    """
+    def __init__(self, callback, quiet=WATCH_TIMEOUT,
+                 max_latency=WATCH_MAX_LATENCY):
+        import threading
+
+        self.callback = callback
+        self.quiet = quiet
+        self.max_latency = max_latency
+        self.paths = set()
+        self.first = self.last = None  # When paths were first and last added
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    def join(self):
+        self.thread.join()
+
+    def add(self, paths):
+        """
+        Add changed paths to the next batch.
+        """
+        with self.condition:
+            self.last = time()
+            if not self.paths:
+                self.first = self.last
+            self.paths.update(paths)
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.paths and not self.stopped:
+                    self.condition.wait()
+
+                # Wait until things quiet down, but not forever
+                while not self.stopped:
+                    remaining = min(self.last + self.quiet,
+                                    self.first + self.max_latency) - time()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+
+                if self.stopped:
+                    return
+                paths, self.paths = self.paths, set()
+
+            # Keep going after a bad batch, so that fixing it is noticed
+            try:
+                self.callback(paths)
+            except Exception as e:
+                logger.error(e)
+
+
+class Profiler(object):
+    """
+    Adds up wall clock and CPU time spent in phases of work,
+    overall and per file.
+    """
+    def __init__(self):
+        from threading import Lock
+        self.phases = {}  # Phase -> [wall, CPU, count]
+        self.files = {}   # File -> phase -> [wall, CPU]
+        self.lock = Lock()  # Files are written on other threads
+
+    @contextmanager
+    def phase(self, name, path=None):
+        """
+        Time what is done within the context as part of a phase,
+        for a file if given.
+        """
+        wall = time()
+        cpu = cpu_time()
+        try:
+            yield
+        finally:
+            wall = time() - wall
+            cpu = cpu_time() - cpu
+            with self.lock:
+                total = self.phases.setdefault(name, [0, 0, 0])
+                total[0] += wall
+                total[1] += cpu
+                total[2] += 1
+                if path:
+                    total = self.files.setdefault(path, {}).setdefault(
+                        name, [0, 0])
+                    total[0] += wall
+                    total[1] += cpu
+
+    def slowest(self, top=PROFILE_TOP):
+        """
+        Get the top slowest files as tuples of (file, wall, CPU).
+        """
+        files = [(path, sum(t[0] for t in phases.values()),
+                  sum(t[1] for t in phases.values()))
+                 for path, phases in self.files.items()]
+        files.sort(key=lambda f: f[1], reverse=True)
+        return files[:top]
+
+    def report(self, top=PROFILE_TOP):
+        """
+        Get a table of the phases and the top slowest files.
+        """
+        lines = ["%-24s %10s %10s %7s" % ('Phase', 'Wall ms', 'CPU ms',
+                                           'Count')]
+        for name, (wall, cpu, count) in sorted(
+                self.phases.items(), key=lambda p: p[1][0], reverse=True):
+            lines.append("%-24s %10.1f %10.1f %7d"
+                         % (name, wall * 1000, cpu * 1000, count))
+        lines.append('')
+        lines.append("%10s %10s  %s" % ('Wall ms', 'CPU ms', 'Slowest file'))
+        for path, wall, cpu in self.slowest(top):
+            lines.append("%10.1f %10.1f  %s" % (wall * 1000, cpu * 1000, path))
+        return '\n'.join(lines)
+
+    def to_json(self):
+        """
+        Get the timings as JSON-compatible data, in seconds.
+        """
+        return {
+            'phases': dict(
+                (name, {'wall': wall, 'cpu': cpu, 'count': count})
+                for name, (wall, cpu, count) in self.phases.items()),
+            'files': dict(
+                (path, dict((name, {'wall': wall, 'cpu': cpu})
+                            for name, (wall, cpu) in phases.items()))
+                for path, phases in self.files.items()),
+        }
+
+
+class NullProfiler(object):
+    """
+    A profiler which times nothing.
+    """
+    @contextmanager
+    def phase(self, name, path=None):
+        yield
+
+
+class StaticFile(object):
+    """
+    A file in the templates directory to copy as it is, since it is either
+    binary or text without any Jinja2 syntax.
+    """
+    def __init__(self, path, binary=False):
+        self.path = path
+        self.binary = binary
+
+    def text(self):
+        with codecs.open(self.path, 'r', 'utf-8') as f:
+            return f.read()
+
+
+def result_matches(path, result, template):
+    # Whether a file already has what its template renders to,
+    # and the template's permissions
+    if isinstance(result, StaticFile):
+        matches = files_match(path, result.path)
+    else:
+        matches = file_matches(path, result.encode('utf-8'))
+    return matches and modes_match(path, template)
+
+
+class Writer(object):
+    """
+    Writes renders to their destinations on background threads,
+    so that writing overlaps with rendering, reporting them in the order
+    they were queued.
+    """
+    def __init__(self, zenbu, threads=WRITE_THREADS, fsync=False):
+        from threading import Thread
+        try:
+            from queue import Queue
+        except ImportError:
+            from Queue import Queue
+
+        self.zenbu = zenbu
+        self.fsync = fsync              # Whether to flush writes to disk
+        self.dirs = set()               # Directories known to exist
+        self.pending = Queue(WRITE_QUEUE_SIZE)  # Renders to write
+        self.results = Queue()          # (Number, result) as they finish
+        self.done = {}                  # Number -> result, until its turn
+        self.queued = 0                 # Renders queued or failed so far
+        self.next = 0                   # Number of the next result to yield
+        self.threads = [Thread(target=self.run) for _ in range(threads)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def put(self, template, dest, result):
+        """
+        Queue a render to be written, waiting if too many are queued.
+        """
+        self.pending.put((self.queued, template, dest, result))
+        self.queued += 1
+
+    def fail(self, template, dest, error):
+        """
+        Report a render which failed in its turn, like a failed write.
+        """
+        self.results.put((self.queued, (template, dest, None, error)))
+        self.queued += 1
+
+    def finished(self):
+        """
+        Yield tuples of (template file, destination file, whether it was
+        written, error) for the writes finished since last time, holding
+        back any finished before writes queued earlier.
+        """
+        try:
+            from queue import Empty
+        except ImportError:
+            from Queue import Empty
+
+        while True:
+            try:
+                number, result = self.results.get_nowait()
+            except Empty:
+                break
+            self.done[number] = result
+        while self.next in self.done:
+            yield self.done.pop(self.next)
+            self.next += 1
+
+    def close(self):
+        """
+        Wait for every queued render to be written, then yield the
+        results not yet seen like finished().
+        """
+        for _ in self.threads:
+            self.pending.put(None)
+        for thread in self.threads:
+            thread.join()
+
+        # Renames are only durable once their directories are flushed
+        if self.fsync:
+            for path in self.dirs:
+                try:
+                    fsync_path(path)
+                except (IOError, OSError) as e:
+                    logger.error(WriteError(path, e))
+        return self.finished()
+
+    def run(self):
+        """
+        Write renders until told to stop, then flush what was written.
+        """
+        to_flush = []
+        while True:
+            render = self.pending.get()
+            if render is None:
+                break
+            number, template, dest, result = render
+            try:
+                changed = self.zenbu.write(template, dest, result, self.dirs)
+            # From rendering a stream
+            except PathException as e:
+                self.results.put((number, (template, dest, None, str(e))))
+                continue
+            except Exception as e:
+                self.results.put((number, (template, dest, None,
+                                           str(WriteError(dest, e)))))
+                continue
+            if changed and self.fsync:
+                to_flush.append((number, template, dest))
+            else:
+                self.results.put((number, (template, dest, changed, None)))
+
+        # All at the end, to keep them from holding up other writes
+        for number, template, dest in to_flush:
+            try:
+                fsync_path(dest)
+                self.results.put((number, (template, dest, True, None)))
+            except (IOError, OSError) as e:
+                self.results.put((number, (template, dest, None,
+                                           str(WriteError(dest, e)))))
+
+
+class YamlCache(object):
+    """
+    Parsed YAML files, reparsed only when their modification time or size
+    changes. Callers must not modify the parsed data.
+    """
+    def __init__(self):
+        self.entries = {}  # Path -> (mtime, size, data)
+        self.dirty = False
+
+    def load(self, path):
+        """
+        Parse a YAML file, or reuse its last parse if it is unchanged.
+        """
+        st = os.stat(path)
+        key = (getattr(st, 'st_mtime_ns', st.st_mtime), st.st_size)
+        entry = self.entries.get(path)
+        if entry and entry[:2] == key:
+            return entry[2]
+
+        # Only import PyYAML to parse, since importing it is slow
+        import yaml
+
+        # Use libyaml when available
+        try:
+            from yaml import CFullLoader as YamlLoader
+        except ImportError:
+            from yaml import FullLoader as YamlLoader
+
+        with codecs.open(path, 'r', 'utf-8') as f:
+            data = yaml.load(f.read(), Loader=YamlLoader)
+        self.entries[path] = key + (data,)
+        self.dirty = True
+        return data
+
+    def read(self, cache_file):
+        """
+        Add the parses saved in a cache file, if it is usable.
+        """
+        import pickle
+        try:
+            with open(cache_file, 'rb') as f:
+                entries = pickle.load(f)
+        # A stale or corrupt cache is just a cache miss
+        except Exception:
+            return
+        if isinstance(entries, dict):
+            entries.update(self.entries)
+            self.entries = entries
+
+    def write(self, cache_file):
+        """
+        Save the parses to a cache file, if there are new ones.
+        """
+        import pickle
+        if self.dirty:
+            write_atomically(
+                cache_file,
+                pickle.dumps(self.entries, pickle.HIGHEST_PROTOCOL))
+            self.dirty = False
+
+
+# Shared by every Zenbu in this process
+yaml_cache = YamlCache()
+
+
+class IgnoreMatcher(object):
+    """
+    Ignore patterns combined into one regex, with memoized results.
+    """
+    # Backreferences and conditionals, which refer to groups by number or
+    # name, so would refer to other patterns' groups once combined
+    group_reference = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+
+    def __init__(self, patterns=()):
+        self.patterns = list(patterns)
+        self.results = {}  # Name -> whether it matches
+
+        # Patterns with global flags can't be combined; match them one by
+        # one, as well as patterns referring to their own groups
+        separate = [p for p in self.patterns
+                    if self.group_reference.search(p)]
+        combined = [p for p in self.patterns if p not in separate]
+        try:
+            self.regexes = [re.compile(
+                '|'.join('(?:%s)' % p for p in combined))] \
+                if combined else []
+        except re.error:
+            self.regexes = [re.compile(p) for p in combined]
+        self.regexes.extend(re.compile(p) for p in separate)
+
+    def matches(self, name):
+        if name not in self.results:
+            self.results[name] = any(r.match(name) for r in self.regexes)
+        return self.results[name]
+
+    def match(self, path):
+        """
+        Check if a relative path or its base name matches a pattern.
+        """
+        return self.matches(os.path.basename(path)) or self.matches(path)
+
+    def match_tree(self, path):
+        """
+        Check if a relative path or any directory it is in matches a pattern.
+        """
+        while path:
+            if self.match(path):
+                return True
+            path = os.path.dirname(path)
+        return False
+
+
+class VariableStore(object):
+    """
+    Variables in layers, each overriding the ones before it, with mappings
+    merged through the layers. Merged and rendered values are kept in a
+    dict, and when layers are replaced only the variables in them, and the
+    variables using those, are merged and rendered again.
+    """
+    def __init__(self, values, references, render):
+        self.values = values          # Name -> merged and rendered value
+        self.references = references  # Value -> names of variables it uses
+        self.render = render          # Renders variables into a dict
+        self.layers = []              # Mappings, lowest first
+        self.uses = {}                # Name -> names of variables it uses
+        self.users = {}               # Name -> names of variables using it
+
+    def merge(self, name):
+        """
+        Get a variable's value from the layers, merging mappings from later
+        layers into those from earlier ones.
+        """
+        found = []
+        for layer in reversed(self.layers):
+            if name in layer:
+                found.append(layer[name])
+                if not isinstance(found[-1], Mapping):
+                    break
+        if not found:
+            raise KeyError(name)
+        if not isinstance(found[0], Mapping):
+            return found[0]
+
+        # Merge into a new mapping, leaving the layers as they are
+        merged = {}
+        for value in reversed(found):
+            if isinstance(value, Mapping):
+                deep_update_dict(merged, value)
+        return merged
+
+    def update(self, layers, everything=False):
+        """
+        Replace the layers, merging and rendering again the variables in
+        layers which were replaced, or every variable if everything is set.
+        Return the names of the variables whose values changed.
+        """
+        # Variables in layers which were added, removed or moved
+        old_layers, self.layers = self.layers, list(layers)
+        names = set()
+        for i in range(max(len(old_layers), len(self.layers))):
+            old = old_layers[i] if i < len(old_layers) else {}
+            new = self.layers[i] if i < len(self.layers) else {}
+            if everything or old is not new:
+                names.update(old)
+                names.update(new)
+
+        # And the variables using those, however indirectly
+        pending = list(names)
+        while pending:
+            for user in self.users.get(pending.pop(), ()):
+                if user not in names:
+                    names.add(user)
+                    pending.append(user)
+
+        # Merge them again, noting what they use
+        old_values = {}
+        merged = {}
+        for k in names:
+            if k in self.values:
+                old_values[k] = self.values.pop(k)
+            for used in self.uses.pop(k, ()):
+                self.users[used].discard(k)
+            try:
+                merged[k] = self.merge(k)
+            except KeyError:
+                continue
+            self.uses[k] = self.references(merged[k]) - set([k])
+            for used in self.uses[k]:
+                self.users.setdefault(used, set()).add(k)
+
+        self.render(merged, self.values)
+        return set(k for k in names
+                   if old_values.get(k, self) != self.values.get(k, self))
+
+
+# Per-template jobs, run either in-process or in a worker pool
+def render_job(zenbu, pair):
+    template, dest = pair
+    try:
+        return template, dest, zenbu.render_template(template), None
+    except PathException as e:
+        return template, dest, None, str(e)
+
+
+def stream_job(zenbu, pair):
+    # The render is only streamed when iterated, by the caller
+    template, dest = pair
+    try:
+        return template, dest, zenbu.render_template(template, True), None
+    except PathException as e:
+        return template, dest, None, str(e)
+
+
+def stream_write_job(zenbu, pair):
+    # Streams straight to the destination, since streams can't be sent
+    # back from worker processes
+    template, dest = pair
+    try:
+        result = zenbu.render_template(template, True)
+        written = zenbu.write(template, dest, result)
+        if written and zenbu.fsync:
+            fsync_path(dest)
+            fsync_path(os.path.dirname(dest))
+        return template, dest, written, None
+    except PathException as e:
+        return template, dest, None, str(e)
+    except Exception as e:
+        return template, dest, None, str(WriteError(dest, e))
+
+
+# Worker process state
+worker_zenbu = None
+
+
+def init_worker(options):
+    global worker_zenbu
+    logger.disabled = True  # The parent process reports results
+    try:
+        worker_zenbu = Zenbu(**options)
+    except PathException as e:
+        worker_zenbu = e
+
+
+def run_worker_job(job):
+    func, pair = job
+    if isinstance(worker_zenbu, PathException):
+        return pair + (None, str(worker_zenbu))
+    return func(worker_zenbu, pair)
+
+
+class LogBuffer(logging.Handler):
+    """
+    Keeps what is logged, for another process to log.
+    """
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []  # (level, message)
+
+    def emit(self, record):
+        self.records.append((record.levelno, record.getMessage()))
+
+
+def batch_job(zenbu, job):
+    variables, dest = job
+    try:
+        # Only create the destination once the job's variables are loaded
+        sibling = zenbu.sibling(variables, dest)
+        make_dirs(dest)
+        return dest, sibling.render_and_write(), None
+    except PathException as e:
+        return dest, None, str(e)
+    except (IOError, OSError) as e:
+        return dest, None, str(WriteError(dest, e))
+
+
+# Batch worker process state
+worker_log = None
+
+
+def init_batch_worker(options, buckets, yaml_entries):
+    global worker_zenbu, worker_log
+    # Start with what the parent process already compiled and parsed
+    yaml_cache.entries.update(yaml_entries)
+    worker_log = LogBuffer()
+    logger.handlers = [worker_log]
+    logger.propagate = False
+    try:
+        worker_zenbu = Zenbu(
+            bytecode_cache=memory_bytecode_cache(buckets)
+            if buckets is not None else None,
+            **options)
+    except PathException as e:
+        worker_zenbu = e
+
+
+def run_batch_worker_job(job):
+    # Returns batch_job's result and what it logged
+    if isinstance(worker_zenbu, PathException):
+        return job[1], None, str(worker_zenbu), []
+    del worker_log.records[:]
+    return batch_job(worker_zenbu, job) + (list(worker_log.records),)
 
 
 # Handler for all events
-class AllEventsHandler(FileSystemEventHandler):
+class AllEventsHandler(object):
+    # Not a watchdog FileSystemEventHandler, to avoid importing watchdog;
+    # observers only need dispatch().
     def __init__(self, callback):
         self.callback = callback
 
-    def on_any_event(self, event):
+    def dispatch(self, event):
         self.callback(event)
 
 
@@ -253,11 +1244,58 @@ class Zenbu:
                  filters_path=None,
                  ignores_path=None,
                  watch_command=None,
-                 watch_dirs=None):
+                 watch_dirs=None,
+                 cache_path=None,
+                 jobs=1,
+                 watch_quiet=WATCH_TIMEOUT,
+                 watch_max_latency=WATCH_MAX_LATENCY,
+                 environ=None,
+                 bytecode_cache=None,
+                 profiler=None,
+                 fsync=False,
+                 link=False,
+                 stream=False):
+
+        # Arguments for worker processes to build their own copy with
+        self.options = {
+            'templates_path': templates_path,
+            'dest_path': dest_path,
+            'var_set_path': var_set_path,
+            'use_env_vars': use_env_vars,
+            'variables': list(variables or []),
+            'filters_path': filters_path,
+            'ignores_path': ignores_path,
+            'cache_path': cache_path,
+            'environ': environ,
+            'fsync': fsync,
+            'link': link,
+            'stream': stream,
+        }
+        if not jobs:
+            from multiprocessing import cpu_count
+            jobs = cpu_count()
+        self.jobs = jobs                  # Number of processes to render in
+        self.profiler = profiler or NullProfiler()
+        self.fsync = fsync                # Whether to flush writes to disk
+        self.link = link                  # Whether to link static files
+        self.stream = stream              # Whether to stream renders to disk
+        self.kinds = {}                   # Template file -> (stamp, kind)
 
         self.variables = variables or []  # Variable sets to apply
         self.use_env_vars = use_env_vars  # Whether or not to use env vars
+        self.environ = environ            # Env vars to use, if not our own
         self.watch_paths = set()          # List of paths to watch
+        self.index = None                 # Template file -> destination
+        self.index_order = None           # Sorted template files
+        self.ignores = IgnoreMatcher()    # Ignore patterns
+        self.references = {}              # Template name -> what it uses
+        self.referenced = set()           # Names some template references
+        self.variable_files = []          # Variable files in use
+        self.expressions = {}             # Variable value -> compiled
+        self.stamps = {}                  # Input file -> (stamp, hash)
+        self.environ_vars = None          # Env vars last used
+        self.variables_changed = set()    # Variables the last refresh changed
+        self.render_errors = 0            # Failed renders in the last render
 
         # Check required paths
         if os.path.exists(templates_path):
@@ -273,27 +1311,45 @@ class Zenbu:
         else:
             raise NotFoundError(dest_path, "destination path")
 
-        # Watchdog
-        self.observer = Observer()
+        # Watchdog, started by watch()
+        self.observer = None
+        self.debouncer = None
         self.watch_command = watch_command
+        self.watch_quiet = watch_quiet
+        self.watch_max_latency = watch_max_latency
+
+        from jinja2 import Environment, FileSystemLoader, StrictUndefined
+
+        # Compiled template cache, unless one is shared with us
+        if cache_path:
+            self.cache_path = os.path.abspath(cache_path)
+            if not os.path.isdir(self.cache_path):
+                os.makedirs(self.cache_path)
+            if not bytecode_cache:
+                bytecode_cache = file_bytecode_cache(self.cache_path)
+            yaml_cache.read(os.path.join(self.cache_path, YAML_CACHE_FILE))
+        else:
+            self.cache_path = None
 
         # Jinja2
         self.env = Environment(loader=FileSystemLoader(self.templates_path),
                                keep_trailing_newline=True,
                                undefined=StrictUndefined,
                                autoescape=False,
-                               cache_size=0)
+                               cache_size=TEMPLATE_CACHE_SIZE,
+                               auto_reload=True,
+                               bytecode_cache=bytecode_cache)
         self.defaults = {
             'filters': self.env.filters,
-            'globals': self.env.globals,
+            'globals': self.env.globals.copy(),
         }
+        self.variable_store = VariableStore(
+            self.env.globals, self.variable_references, self.render_variables)
 
         # Variables
         if var_set_path:
             if os.path.exists(var_set_path):
                 self.var_set_path = os.path.abspath(var_set_path)
-                self.var_set_path_re = re.compile(
-                    '^{}{}?'.format(self.var_set_path, os.sep))
                 self.watch_paths.add(self.var_set_path)
             else:
                 raise NotFoundError(var_set_path, "variable set path")
@@ -303,14 +1359,15 @@ class Zenbu:
         # Filters
         if filters_path:
             if os.path.exists(filters_path):
-                filters_path = os.path.abspath(filters_path)
-                sys.path.append(os.path.dirname(filters_path))
+                self.filters_path = os.path.abspath(filters_path)
+                sys.path.append(os.path.dirname(self.filters_path))
                 self.filters_module = os.path.splitext(
-                    os.path.basename(filters_path))[0]
-                self.watch_paths.add(filters_path)
+                    os.path.basename(self.filters_path))[0]
+                self.watch_paths.add(self.filters_path)
             else:
                 raise NotFoundError(filters_path, "filters path")
         else:
+            self.filters_path = None
             self.filters_module = None
 
         # Ignores
@@ -330,46 +1387,135 @@ class Zenbu:
         # Initial setup
         self.refresh()
 
-    def refresh(self):
+    def input_changed(self, path):
         """
-        Refresh ignores, variables, and filters.
+        Check if an input file changed since the last time it was checked,
+        by its contents if its modification time or size changed.
         """
-        # Get ignores
-        self.ignores = set()
-        if self.ignores_path:
-            self.add_ignores(self.ignores_path)
-
-        # Get filters
-        self.env.filters = self.defaults['filters'].copy()
-        if self.filters_module:
-            try:
-                deep_update_dict(
-                    self.env.filters,
-                    vars(import_module(self.filters_module)))
-            except ImportError:
-                pass
+        known = self.stamps.get(path)
+        stamp = file_stamp(path)
+        if known and known[0] == stamp:
+            return False
+        if stamp:
+            with open(path, 'rb') as f:
+                digest = hash_file(f)
+        else:
+            digest = None
+        self.stamps[path] = (stamp, digest)
+        return not known or known[1] != digest
 
-        # Get variables
-        self.env.globals = self.defaults['globals'].copy()
-        if self.use_env_vars:
-            self.env.globals.update(dict(os.environ))
-        for name in self.variables:
-            self.add_variables(name)
-        self.env.globals = self.render_variables(self.env.globals)
+    def forget_input(self, path):
+        """
+        Make an input file count as changed next time it is checked,
+        while still counting as having been checked before.
+        """
+        if path in self.stamps:
+            self.stamps[path] = (None, None)
 
-    def add_variables(self, name):
+    def variables_path(self, name):
         """
-        Add variables to the environment.
+        Get the path of a variables file from its path or set name.
         """
         # If it might be just a name...
         if self.var_set_path and not os.path.exists(name):
             name = os.path.join(self.var_set_path, '{}.{}'.format(
                 name, TEMPLATE_EXT))
+        return name
+
+    def refresh(self):
+        """
+        Refresh ignores, filters, and variables, redoing only those whose
+        inputs changed since the last refresh. Returns the names of the
+        ones that changed.
+        """
+        changed = set()
 
+        # Get ignores, keeping the matcher's memos and the template index
+        # unless the patterns changed
+        if self.input_changed(self.ignores_path):
+            ignores = self.ignores
+            self.ignores = IgnoreMatcher()
+            try:
+                if self.ignores_path:
+                    self.add_ignores(self.ignores_path)
+            except Exception:
+                # Keep the old patterns, and try again next refresh
+                self.ignores = ignores
+                self.forget_input(self.ignores_path)
+                raise
+            if self.ignores.patterns == ignores.patterns:
+                self.ignores = ignores
+            else:
+                self.index = None
+                changed.add('ignores')
+
+        # Get filters, reloading the module if it changed since we got it
+        loaded = self.filters_path in self.stamps
+        if self.input_changed(self.filters_path):
+            filters = self.defaults['filters'].copy()
+            if self.filters_module:
+                try:
+                    module = sys.modules.get(self.filters_module)
+                    if module and loaded:
+                        module = reload(module)
+                        # Constant expressions were filtered when compiled
+                        if self.env.bytecode_cache:
+                            self.env.bytecode_cache.clear()
+                    else:
+                        module = import_module(self.filters_module)
+                    deep_update_dict(filters, vars(module))
+                except ImportError:
+                    pass
+                except Exception:
+                    # Keep the old filters, and try again next refresh
+                    self.forget_input(self.filters_path)
+                    raise
+            self.env.filters = filters
+            self.expressions = {}
+            self.env.cache.clear()
+            if self.env.bytecode_cache is not None:
+                self.env.bytecode_cache.salt = \
+                    self.stamps[self.filters_path][1] or ''
+            changed.add('filters')
+
+        # Get variables, in place since cached templates refer to them.
+        # The environment is a layer as it is, kept while it is unchanged
+        variable_files = [self.variables_path(n) for n in self.variables]
+        environ_vars = (self.environ or os.environ) \
+            if self.use_env_vars else None
+        environ_changed = environ_vars is not self.environ_vars and \
+            environ_vars != self.environ_vars
+        modified = [f for f in variable_files if self.input_changed(f)]
+        if modified or 'filters' in changed or \
+                variable_files != self.variable_files or environ_changed:
+            self.variable_files = []
+            if environ_changed:
+                self.environ_vars = environ_vars
+            layers = [self.defaults['globals'], self.environ_vars or {}]
+            layers.extend(self.load_variables(name)
+                          for name in self.variables)
+            # Rendered values depend on the filters
+            with self.profiler.phase('render variables'):
+                self.variables_changed = self.variable_store.update(
+                    layers, everything='filters' in changed)
+            changed.add('variables')
+
+            # Save new parses for next time
+            if self.cache_path:
+                yaml_cache.write(
+                    os.path.join(self.cache_path, YAML_CACHE_FILE))
+
+        return changed
+
+    def load_variables(self, name):
+        """
+        Load a variable file, returning its variables.
+        """
+        name = self.variables_path(name)
         try:
-            with codecs.open(name, 'r', 'utf-8') as f:
-                to_merge = yaml.load(f.read(), Loader=yaml.FullLoader)
-        except IOError:
+            with self.profiler.phase('load variables', name):
+                to_merge = yaml_cache.load(name)
+        except (IOError, OSError):
             raise NotFoundError(name, "variables file")
         except Exception as e:
             raise ParseError(name, e)
@@ -377,58 +1523,152 @@ class Zenbu:
             self.watch_paths.add(name)
             if isinstance(to_merge, dict):
                 logger.info("Using \"%s\"..." % name)
-                deep_update_dict(self.env.globals, to_merge)
+                self.variable_files.append(name)
+                return to_merge
             else:
                 raise ParseError(name, "  (not in mapping format)")
 
-    def render_variables(self, vars):
+    def has_syntax(self, text):
+        """
+        Check if text has any Jinja2 syntax to render.
+        """
+        return (self.env.variable_start_string in text or
+                self.env.block_start_string in text or
+                self.env.comment_start_string in text)
+
+    def is_expression(self, value):
         """
-        Shallowly resolves variables within variables.
+        Check if a variable's value has any Jinja2 syntax to render.
+        """
+        return isinstance(value, str) and self.has_syntax(value)
+
+    def compile_expression(self, source):
         """
-        rendered = {}  # to avoid rendering order problems
+        Get a tuple of (compiled template, names of the variables it uses)
+        for a variable's value, compiling it only once.
+        """
+        if source not in self.expressions:
+            from jinja2 import nodes
+            ast = self.env.parse(source)
+            names = set(node.name for node in ast.find_all(nodes.Name)
+                        if node.ctx == 'load')
+            self.expressions[source] = (self.env.from_string(ast), names)
+        return self.expressions[source]
+
+    def variable_references(self, value):
+        """
+        Get the names of the variables used anywhere within a variable.
+        """
+        from jinja2 import TemplateSyntaxError
+
+        if isinstance(value, dict):
+            names = set()
+            for v in value.values():
+                names |= self.variable_references(v)
+            return names
+        if self.is_expression(value):
+            try:
+                return self.compile_expression(value)[1]
+            # Reported when rendering
+            except TemplateSyntaxError:
+                pass
+        return set()
+
+    def render_variables(self, vars, context):
+        """
+        Resolves variables within variables into context, rendering each
+        variable after the variables it uses, with those in context.
+        """
+        # Which other variables each variable uses
+        uses = {}
         for k, v in vars.items():
-            # Recurse
-            if isinstance(v, dict):
-                rendered[k] = self.render_variables(v)
-            # Render
-            elif isinstance(v, str):
-                try:
-                    rendered[k] = self.env.from_string(v).render()
-                except UndefinedError as e:
-                    logger.error(VariableRenderError(k, e))
-                except TemplateSyntaxError as e:
-                    logger.error(VariableRenderError(k, e.message))
-                # For all other errors in rendering
-                except Exception as e:
-                    logger.error(VariableRenderError(k, e))
-            else:
-                rendered[k] = v
-        return rendered
+            uses[k] = set(name for name in self.variable_references(v)
+                          if name != k and name in vars)
+
+        # Depth-first topological sort, leaving out cycles
+        order = []
+        done = set()
+        cyclic = set()
+        for k in sorted(uses):
+            stack = [(k, iter(sorted(uses[k])))]
+            path = [k]
+            while stack:
+                name, deps = stack[-1]
+                for dep in deps:
+                    if dep in path:
+                        cyclic.update(path[path.index(dep):])
+                    elif dep not in done:
+                        stack.append((dep, iter(sorted(uses[dep]))))
+                        path.append(dep)
+                        break
+                else:
+                    stack.pop()
+                    path.pop()
+                    if name not in done:
+                        done.add(name)
+                        order.append(name)
+
+        # Variables see the already resolved values of those they use
+        context.update(vars)
+        for k in order:
+            if k in cyclic:
+                del context[k]
+                logger.error(VariableRenderError(
+                    k, "part of a cycle of variables"))
+                continue
+            if not self.render_variable(context, k, vars[k], context):
+                context.pop(k, None)
+
+    def render_variable(self, rendered, k, v, context):
+        """
+        Render a variable into rendered with the given variables in
+        context, returning whether it rendered.
+        """
+        from jinja2 import UndefinedError, TemplateSyntaxError
+
+        # Recurse
+        if isinstance(v, dict):
+            result = {}
+            for nested_k, nested_v in v.items():
+                self.render_variable(result, nested_k, nested_v, context)
+            rendered[k] = result
+            return True
+
+        # Plain values stay as they are
+        if not self.is_expression(v):
+            rendered[k] = v
+            return True
+
+        # Render
+        try:
+            template = self.compile_expression(v)[0]
+            rendered[k] = template.environment.concat(
+                template.root_render_func(
+                    template.new_context(context, shared=True)))
+            return True
+        except UndefinedError as e:
+            logger.error(VariableRenderError(k, e))
+        except TemplateSyntaxError as e:
+            logger.error(VariableRenderError(k, e.message))
+        # For all other errors in rendering
+        except Exception as e:
+            logger.error(VariableRenderError(k, e))
+        return False
 
     def add_ignores(self, name):
         """
         Add patterns to the ignore list.
         """
-        try:
-            with codecs.open(name, 'r', 'utf-8') as f:
-                to_merge = yaml.load(f.read(), Loader=yaml.FullLoader)
-        except Exception as e:
-            raise ParseError(e, name)
-        else:
-            self.watch_paths.add(name)
-            if isinstance(to_merge, list):
-                self.ignores |= set(re.compile(i) for i in to_merge)
-            else:
-                raise ParseError(name, "  (not in scalar format)")
+        self.ignores = IgnoreMatcher(
+            self.ignores.patterns + load_ignore_patterns(name))
+        self.watch_paths.add(name)
 
     def should_ignore(self, name):
         """
-        Check if a name should be ignored according to self.ignores
+        Check if a name or relative path should be ignored according to
+        self.ignores, including because a directory it is in is ignored.
         """
-        for pattern in self.ignores:
-            if pattern.match(name):
-                return True
-        return False
+        return self.ignores.match_tree(name)
 
     @property
     def var_sets(self):
@@ -437,163 +1677,642 @@ class Zenbu:
         """
         # Does our folder exist?
         if self.var_set_path:
+            for name in scan_var_sets(self.var_set_path,
+                                      self.ignores.match)[0]:
+                yield name
+        else:
+            raise ValueError("No variable set path to list from.")
 
-            # Get all the paths...
-            for root, _, files in os.walk(self.var_set_path,
-                                          followlinks=True):
+    def index_templates(self, name=''):
+        """
+        Add the template files at a path relative to the templates
+        directory to the template index.
+        """
+        path = os.path.join(self.templates_path, name)
+        if os.path.isdir(path):
+            names = (os.path.join(name, n)
+                     for n in walk_files(path, self.ignores.match))
+        elif os.path.exists(path):
+            names = [name]
+        else:
+            names = []
 
-                # Don't print the var set dir
-                short_root = self.var_set_path_re.sub('', root)
+        for short_name in names:
+            # Substitute the template dir for home dir
+            template = os.path.join(self.templates_path, short_name)
+            self.index[template] = os.path.join(self.dest_path, short_name)
+        self.index_order = None
 
-                for name in files:
-                    if not self.should_ignore(name):
-                        path = os.path.join(short_root, name)
+    def update_index(self, names):
+        """
+        Update the template index for paths relative to the templates
+        directory which were created, deleted, moved or modified.
+        """
+        if self.index is None:
+            return
+
+        for name in names:
+            # Forget what used to be there
+            template = os.path.join(self.templates_path, name)
+            if template in self.index:
+                del self.index[template]
+            else:
+                prefix = os.path.join(template, '')
+                for t in [t for t in self.index if t.startswith(prefix)]:
+                    del self.index[t]
 
-                        # Yield without .yaml
-                        yield os.path.splitext(path)[0]
-        else:
-            raise ValueError("No variable set path to list from.")
+            if not self.should_ignore(name):
+                self.index_templates(name)
+        self.index_order = None
 
     @property
     def render_pairs(self):
         """
         Yield pairs of (template file, destination file)
         """
-        for root, _, files in os.walk(self.templates_path,
-                                      followlinks=True):
+        if self.index is None:
+            self.index = {}
+            with self.profiler.phase('walk templates'):
+                self.index_templates()
+        if self.index_order is None:
+            self.index_order = sorted(self.index)
+        for template in self.index_order:
+            yield (template, self.index[template])
+
+    def template_name(self, template):
+        """
+        Get the Jinja2 name of a template file.
+        """
+        return self.templates_path_re.sub('', template)
 
-            # Substitute the template dir for home dir
-            dest_root = os.path.join(
-                self.dest_path,
-                self.templates_path_re.sub('', root))
+    def template_references(self, name):
+        """
+        Get a tuple of (names of the templates a template includes, extends
+        or imports, or None if they can't all be determined statically,
+        names of the global variables it uses).
+        """
+        if name not in self.references:
+            from jinja2 import meta, nodes
+            try:
+                source = self.env.loader.get_source(self.env, name)[0]
+                ast = self.env.parse(source)
+                deps = set()
+                for dep in meta.find_referenced_templates(ast):
+                    if dep is None:
+                        deps = None
+                        break
+                    deps.add(dep)
+                # Not meta.find_undeclared_variables, which leaves out
+                # names that are already globals
+                variables = set(node.name for node in ast.find_all(nodes.Name)
+                                if node.ctx == 'load')
+            # Missing or unparseable templates reference nothing
+            except Exception:
+                deps, variables = set(), set()
+            self.references[name] = (deps, variables)
+        return self.references[name]
+
+    def dependency_graph(self):
+        """
+        Get a tuple of (mapping of template name to the names of templates
+        that directly depend on it, names of templates with dynamic
+        dependencies).
+        """
+        graph = {}
+        dynamic = set()
+        pending = [self.template_name(t) for t, _ in self.render_pairs]
+        seen = set(pending)
+        while pending:
+            name = pending.pop()
+            deps, _ = self.template_references(name)
+            if deps is None:
+                dynamic.add(name)
+                continue
+            for dep in deps:
+                graph.setdefault(dep, set()).add(name)
+                if dep not in seen:
+                    seen.add(dep)
+                    pending.append(dep)
+        self.referenced = set(graph)
+        return graph, dynamic
+
+    def templates_using(self, variables):
+        """
+        Get the names of the templates which directly use any of
+        the given global variables.
+        """
+        self.dependency_graph()  # Make sure every template is parsed
+        return set(name for name, (_, used) in self.references.items()
+                   if used & variables)
+
+    def affected_templates(self, names):
+        """
+        Get the template files which need rendering when the given
+        template names change.
+        """
+        graph, dynamic = self.dependency_graph()
+        affected = set()
+        pending = list(names) + list(dynamic)
+        while pending:
+            name = pending.pop()
+            if name not in affected:
+                affected.add(name)
+                pending.extend(graph.get(name, ()))
+        return set(os.path.join(self.templates_path, name)
+                   for name in affected)
+
+    def template_kind(self, template):
+        """
+        Get whether a file in the templates directory is a 'template' to
+        render, or a 'binary' or 'static' file to copy as it is.
+        """
+        stamp = file_stamp(template)
+        known = self.kinds.get(template)
+        if known and known[0] == stamp:
+            return known[1]
+
+        with open(template, 'rb') as f:
+            data = f.read(HASH_CHUNK_SIZE)
+            if b'\0' not in data:
+                data += f.read()
+        try:
+            text = None if b'\0' in data else data.decode('utf-8')
+        except UnicodeDecodeError:
+            text = None
+
+        if text is None:
+            kind = 'binary'
+        # Jinja2 turns \r\n into \n, which copying wouldn't
+        elif '\r' in text or self.has_syntax(text):
+            kind = 'template'
+        else:
+            kind = 'static'
+        self.kinds[template] = (stamp, kind)
+        return kind
 
-            # Iterate through templates
-            for name in files:
-                if not self.should_ignore(name):
-                    template = os.path.join(root, name)
-                    dest = os.path.join(dest_root, name)
-                    yield (template, dest)
+    def render_template(self, template, stream=False):
+        """
+        Render a template file, or get a StaticFile if it isn't one.
+        If stream, get the render as an iterator of chunks of text instead.
+        If there is a render error, raise it as a RenderError or NotFoundError.
+        """
+        try:
+            with self.profiler.phase('classify', template):
+                kind = self.template_kind(template)
+            if kind != 'template':
+                return StaticFile(template, kind == 'binary')
+
+            # Jinja needs a path from root
+            src = self.template_name(template)
+            with self.profiler.phase('compile', template):
+                compiled = self.env.get_template(src)
+            if stream:
+                return self.stream_template(template, compiled)
+            with self.profiler.phase('render', template):
+                return compiled.render()
+        except Exception as e:
+            raise self.render_error(template, e)
 
-    def render(self):
+    def stream_template(self, template, compiled):
         """
-        Yield tuples of (template file, destination file, what to write).
-        If there is a file render error, log it.
+        Yield chunks of a compiled template's render as they are rendered.
+        If there is a render error, raise it as a RenderError or NotFoundError.
         """
-        for template, dest in self.render_pairs:
-            try:
-                # Jinja needs a path from root
-                src = self.templates_path_re.sub('', template)
-                yield (template, dest, self.env.get_template(src).render())
-            except UndefinedError as e:
-                logger.error(RenderError(template, e))
-            except TemplateSyntaxError as e:
-                logger.error(RenderError(
-                    template, '{} on line {}'.format(e.message, e.lineno)))
-            except UnicodeDecodeError as e:
-                logger.error(RenderError(
-                    template, 'This file is probably not text; {}'.format(e)))
-            except TemplateNotFound as e:
-                logger.error(NotFoundError(template, e))
-            # For all other errors in rendering
-            except Exception as e:
-                tb = traceback.extract_tb(sys.exc_info()[-1])[-1]
-                logger.error(RenderError(
-                    template, '{} at {}:{}: "{}"'.format(
-                        e, tb[0], tb[1], tb[3])))
+        try:
+            for chunk in compiled.generate():
+                yield chunk
+        except Exception as e:
+            raise self.render_error(template, e)
 
-    def render_and_write(self):
+    def render_error(self, template, e):
+        """
+        Get the error to raise for an exception rendering a template.
+        """
+        from jinja2 import UndefinedError, TemplateSyntaxError, \
+            TemplateNotFound
+
+        if isinstance(e, UndefinedError):
+            return RenderError(template, e)
+        if isinstance(e, TemplateSyntaxError):
+            return RenderError(
+                template, '{} on line {}'.format(e.message, e.lineno))
+        if isinstance(e, UnicodeDecodeError):
+            return RenderError(
+                template, 'This file is probably not text; {}'.format(e))
+        if isinstance(e, (TemplateNotFound, IOError, OSError)):
+            return NotFoundError(template, e)
+        # For all other errors in rendering
+        import traceback
+        tb = traceback.extract_tb(sys.exc_info()[-1])[-1]
+        return RenderError(
+            template, '{} at {}:{}: "{}"'.format(e, tb[0], tb[1], tb[3]))
+
+    def sibling(self, variables, dest_path):
+        """
+        Build a Zenbu like this one, but with more variables and another
+        destination path, sharing this one's compiled templates and
+        template index. The destination path needn't exist yet.
+        """
+        # Built with our destination, which exists, then pointed at theirs
+        zenbu = Zenbu(bytecode_cache=self.env.bytecode_cache, **dict(
+            self.options,
+            variables=self.options['variables'] + list(variables)))
+        zenbu.dest_path = os.path.abspath(dest_path)
+        zenbu.options['dest_path'] = zenbu.dest_path
+        zenbu.kinds = self.kinds
+        zenbu.index = dict(
+            (template, os.path.join(zenbu.dest_path,
+                                    os.path.relpath(dest, self.dest_path)))
+            for template, dest in self.render_pairs)
+        return zenbu
+
+    def batch(self, jobs):
         """
-        Render the templates and write them to their destination.
+        Render and write the templates for each of a list of tuples of
+        (variables to add, destination path), spread over self.jobs
+        processes. Compiled templates and parsed variables are shared.
+        Return a list of tuples of (destination path, tuple of (number
+        written, number unchanged) or None if the job failed).
         """
-        for template, dest, result in self.render():
-            # Delete any existing file first
+        from jinja2 import TemplateError
+
+        jobs = [(list(variables), dest) for variables, dest in jobs]
+
+        # Compile every template and parse every variable file up front
+        if self.env.bytecode_cache is None:
+            self.env.bytecode_cache = memory_bytecode_cache()
+        for template, _ in self.render_pairs:
             try:
-                os.remove(dest)
-            except OSError:
+                if self.template_kind(template) == 'template':
+                    self.env.get_template(self.template_name(template))
+            # Reported when rendering
+            except (TemplateError, IOError, OSError, UnicodeDecodeError):
                 pass
+        for variables, _ in jobs:
+            for name in variables:
+                try:
+                    yaml_cache.load(self.variables_path(name))
+                except Exception:
+                    pass
+
+        done = []
+        if not self.uses_workers():
+            for job in jobs:
+                logger.info("\nRendering into \"%s\"..." % job[1])
+                dest, counts, error = batch_job(self, job)
+                if error:
+                    logger.error(error)
+                done.append((dest, counts))
+            return done
+
+        from multiprocessing import Pool
+        pool = Pool(self.jobs, init_batch_worker, (
+            self.options,
+            getattr(self.env.bytecode_cache, 'buckets', None),
+            yaml_cache.entries))
+        try:
+            for dest, counts, error, records in pool.imap(
+                    run_batch_worker_job, jobs):
+                logger.info("\nRendering into \"%s\"..." % dest)
+                for level, message in records:
+                    logger.log(level, message)
+                if error:
+                    logger.error(error)
+                done.append((dest, counts))
+        finally:
+            pool.terminate()
+            pool.join()
+        return done
+
+    def uses_workers(self):
+        """
+        Check if jobs are run in worker processes.
+        """
+        # Profiling needs everything in this process
+        return self.jobs > 1 and isinstance(self.profiler, NullProfiler)
+
+    def run_jobs(self, job, only=None):
+        """
+        Yield the results of a job for each pair of (template file,
+        destination file), in order, spread over self.jobs processes.
+        If only is given, skip template files not in it.
+        """
+        pairs = (pair for pair in self.render_pairs
+                 if only is None or pair[0] in only)
 
-            with make_dirs_and_open(dest) as f:
-                f.write(result)
-                copystat(template, dest)
-                logger.info("Successfully rendered \"%s\"" % dest)
+        if not self.uses_workers():
+            for pair in pairs:
+                yield job(self, pair)
+            return
+
+        from multiprocessing import Pool
+        pool = Pool(self.jobs, init_worker, (self.options,))
+        try:
+            for result in pool.imap(run_worker_job,
+                                    ((job, pair) for pair in pairs),
+                                    JOB_CHUNK_SIZE):
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def render(self, only=None):
+        """
+        Yield tuples of (template file, destination file, what to write).
+        If only is given, skip template files not in it.
+        If there is a file render error, log it and count it in
+        self.render_errors.
+        """
+        self.render_errors = 0
+        for template, dest, result, error in self.run_jobs(render_job, only):
+            if error:
+                logger.error(error)
+                self.render_errors += 1
+            else:
+                yield template, dest, result
 
-    def diff(self):
+    def write(self, template, dest, result, dirs=None):
         """
-        Yield diffs between each template's render and current file.
+        Write a template's rendering, StaticFile or stream of chunks to its
+        destination, unless the destination already has the same contents.
+        dirs, if given, is a set of directories known to exist.
+        Return whether the destination was written.
         """
-        for template, dest, result in self.render():
+        with self.profiler.phase('write', template):
+            if isinstance(result, StaticFile):
+                if result_matches(dest, result, template):
+                    return False
+                # Clone where the filesystem can, or else hard link
+                if self.link:
+                    for link in (reflink_atomically, link_atomically):
+                        try:
+                            link(result.path, dest, dirs)
+                            return True
+                        # Perhaps unsupported, or on another filesystem
+                        except (IOError, OSError):
+                            pass
+                copy_atomically(result.path, dest, dirs)
+                return True
+
+            if not isinstance(result, str):
+                return write_streaming(dest, result, template, dirs)
+
+            data = result.encode('utf-8')
+            if file_matches(dest, data) and modes_match(dest, template):
+                return False
+            write_atomically(dest, data, template, dirs)
+            return True
+
+    def render_and_write(self, only=None):
+        """
+        Render the templates and write the changed ones to their destination.
+        Return a tuple of (number written, number unchanged).
+        """
+        counts = [0, 0]  # Written, unchanged
+
+        def report(results):
+            for _, dest, changed, error in results:
+                if error:
+                    logger.error(error)
+                elif changed:
+                    counts[0] += 1
+                    logger.info("Successfully rendered \"%s\"" % dest)
+                else:
+                    counts[1] += 1
+
+        # Workers stream to their destinations themselves
+        if self.stream and self.uses_workers():
+            report(self.run_jobs(stream_write_job, only))
+
+        # Write on other threads while rendering the rest,
+        # or while streaming renders
+        else:
+            job = stream_job if self.stream else render_job
+            writer = Writer(self, WRITE_THREADS, self.fsync)
+            try:
+                for template, dest, result, error in self.run_jobs(job,
+                                                                   only):
+                    if error:
+                        writer.fail(template, dest, error)
+                    else:
+                        writer.put(template, dest, result)
+                    report(writer.finished())
+            finally:
+                report(writer.close())
+
+        logger.info("Wrote %d files, skipped %d unchanged" % tuple(counts))
+        return tuple(counts)
+
+    def drift(self, only=None):
+        """
+        Yield tuples of (template file, destination file, what to write)
+        for renders which differ from the current file, in contents or
+        permissions.
+        """
+        for template, dest, result in self.render(only):
+            with self.profiler.phase('compare', template):
+                matches = result_matches(dest, result, template)
+            if not matches:
+                yield template, dest, result
+
+    def diff(self, only=None):
+        """
+        Yield diffs between each template's render and current file,
+        skipping files which are identical.
+        """
+        from difflib import unified_diff
+
+        for template, dest, result in self.drift(only):
+            if isinstance(result, StaticFile):
+                if result.binary:
+                    yield ["=== Binary file \"%s\" differs.\n" % dest]
+                    continue
+                result = result.text()
             try:
-                with codecs.open(dest, 'r', 'utf-8') as f:
-                    yield unified_diff(
-                        f.readlines(),
-                        result.splitlines(True),
-                        fromfile=dest,
-                        tofile='%s (rendered)' % dest)
+                with self.profiler.phase('diff', template):
+                    with codecs.open(dest, 'r', 'utf-8') as f:
+                        current = f.readlines()
+                if current == result.splitlines(True):
+                    yield ["=== Permissions of \"%s\" differ.\n" % dest]
+                    continue
+                yield unified_diff(
+                    current,
+                    result.splitlines(True),
+                    fromfile=dest,
+                    tofile='%s (rendered)' % dest)
+            except UnicodeDecodeError:
+                yield ["=== Binary file \"%s\" differs.\n" % dest]
             except IOError:
                 yield [
                     "=== No destination file \"%s\" for comparison.\n"
                     % dest]
 
+    def diff_stat(self, only=None):
+        """
+        Yield tuples of (destination file, lines added, lines removed)
+        for renders which differ from the current file.
+        """
+        from difflib import unified_diff
+        from itertools import islice
+
+        for template, dest, result in self.drift(only):
+            # Binary files have no lines to count
+            if isinstance(result, StaticFile):
+                if result.binary:
+                    yield dest, 0, 0
+                    continue
+                result = result.text()
+
+            with self.profiler.phase('diff', template):
+                try:
+                    with codecs.open(dest, 'r', 'utf-8') as f:
+                        current = f.readlines()
+                except (IOError, UnicodeDecodeError):
+                    current = []
+
+                added = removed = 0
+                diff = unified_diff(current, result.splitlines(True), n=0)
+                for line in islice(diff, 2, None):  # Skip the file headers
+                    if line.startswith('+'):
+                        added += 1
+                    elif line.startswith('-'):
+                        removed += 1
+            yield dest, added, removed
+
     def watch(self):
         """
         Start the file watcher.
         """
-        # Because of read-only closures
-        scope = Scope()
-        scope.timer = None
-
-        def make_handler(file_to_watch=None):
-            def rerender():
-                logger.info("\nRe-rendering...")
-                self.refresh()
+        from subprocess import call
+        from watchdog.observers import Observer
+
+        # Events arrive with symlinks resolved
+        templates_root = os.path.join(
+            os.path.realpath(self.templates_path), '')
+        var_sets_root = os.path.join(
+            os.path.realpath(self.var_set_path), '') \
+            if self.var_set_path else None
+
+        def relative(path):
+            # Ignores match paths within their directory, or base names
+            for root in (templates_root, var_sets_root):
+                if root and path.startswith(root):
+                    return path[len(root):]
+            return os.path.basename(path)
+
+        def is_referenced(path):
+            # Whether another template uses this template
+            return path.startswith(templates_root) and \
+                os.path.relpath(path, templates_root) in self.referenced
+
+        def affected(paths, layers):
+            # Template files to render, or None for all of them
+            variable_files = set(
+                os.path.realpath(f) for f in self.variable_files)
+            names = set()
+            variables_changed = False
+            for path in paths:
+                if path.startswith(templates_root):
+                    names.add(os.path.relpath(path, templates_root))
+                elif path in variable_files or \
+                        var_sets_root and path.startswith(var_sets_root):
+                    variables_changed = True
+                else:
+                    return None
+
+            # Changed templates may have gained or lost references
+            for name in names:
+                self.references.pop(name, None)
+            if variables_changed and 'variables' in layers:
+                names |= self.templates_using(self.variables_changed)
+            return self.affected_templates(names)
+
+        def rerender(changed):
+            logger.info("\nRe-rendering...")
+            layers = self.refresh()
+            self.update_index(
+                os.path.relpath(path, templates_root)
+                for path in changed if path.startswith(templates_root))
+            only = affected(changed, layers)
+
+            # If there is no resulting difference, skip
+            written, _ = self.render_and_write(only)
+            if not written:
+                logger.info("\nNo difference detected - skipping")
+                return
+
+            # Execute watch command
+            if self.watch_command:
+                logger.info("\nExecuting watch command: %s" %
+                            self.watch_command)
+                call(self.watch_command, shell=True)
+
+        # Debounce to prevent thrashing
+        self.debouncer = Debouncer(
+            rerender, self.watch_quiet, self.watch_max_latency)
+
+        def is_watched(path, files):
+            # Whether an event path is one of a directory's watched files,
+            # by name or else by inode, for other names of the same file
+            if path in files['paths']:
+                return True
+            try:
+                st = os.stat(path)
+            except (IOError, OSError):
+                return False
+            return (st.st_dev, st.st_ino) in files['inodes']
 
-                # If there is no resulting difference, skip
-                if not sum(sum(len(d) for d in diff) for diff in self.diff()):
-                    logger.info("\nNo difference detected - skipping")
+        def make_handler(files=None):
+            def schedule_rerender(event):
+                # If nothing was written, skip
+                if event.event_type in WATCH_SKIP_EVENTS:
                     return
 
-                self.render_and_write()
-
-                # Execute watch command
-                if self.watch_command:
-                    logger.info("\nExecuting watch command: %s" %
-                                self.watch_command)
-                    call(self.watch_command, shell=True)
+                paths = [event.src_path]
+                if getattr(event, 'dest_path', None):
+                    paths.append(event.dest_path)
 
-            def schedule_rerender(event):
-                # If we have a specific file, check for it
-                if file_to_watch:
-                    # If the file is gone, skip
-                    if not os.path.exists(file_to_watch) or \
-                            not os.path.exists(event.src_path):
+                # If we have specific files, check for them,
+                # skipping any that are gone
+                if files:
+                    if event.event_type == 'deleted':
                         return
-                    # If we don't care about the file, skip
-                    if not os.path.samefile(file_to_watch, event.src_path):
+                    if event.event_type == 'moved':
+                        paths = paths[1:]
+                    paths = [p for p in paths if is_watched(p, files)]
+                    if not paths:
                         return
 
-                # If it's a directory, skip
+                # Directories only matter to the template index
                 if event.is_directory:
-                    return
-
-                # If we should ignore the file, skip
-                if self.should_ignore(event.src_path):
+                    if event.event_type == 'modified':
+                        return
+                    paths = [p for p in paths
+                             if p.startswith(templates_root)]
+
+                # If we should ignore the files, skip,
+                # unless another template uses them
+                paths = [p for p in paths
+                         if not self.should_ignore(relative(p)) or
+                         is_referenced(p)]
+                if not paths:
                     return
 
                 logger.info("Change detected: \"%s\" (%s)" %
-                            (event.src_path, event.event_type))
-
-                # Debounce to prevent thrashing
-                if scope.timer:
-                    scope.timer.cancel()
-                    scope.timer = None
-
-                scope.timer = Timer(WATCH_TIMEOUT, rerender)
-                scope.timer.start()
+                            (paths[-1], event.event_type))
+                self.debouncer.add(paths)
 
             return AllEventsHandler(schedule_rerender)
 
+        # Find out which templates are used by others
+        self.dependency_graph()
+
         dir_handler = make_handler()
 
+        # Individual files are watched for in their parent directories,
+        # by the paths events name them by, and by inode
+        watched_files = {}  # Directory -> {'paths': set, 'inodes': set}
+        self.observer = Observer()
         for path in self.watch_paths:
             if os.path.isdir(path):
                 self.observer.schedule(
@@ -601,12 +2320,24 @@ class Zenbu:
                     os.path.realpath(path),  # Watch out for symlinks...
                     recursive=True)
             else:
-                # Watch the parent directory for the file pattern
-                self.observer.schedule(
-                    make_handler(path),
-                    os.path.realpath(os.path.dirname(path)),
-                    recursive=False)
+                directory = os.path.realpath(os.path.dirname(path))
+                files = watched_files.setdefault(
+                    directory, {'paths': set(), 'inodes': set()})
+                files['paths'].add(
+                    os.path.join(directory, os.path.basename(path)))
+                files['paths'].add(os.path.realpath(path))
+                try:
+                    st = os.stat(path)
+                    files['inodes'].add((st.st_dev, st.st_ino))
+                except (IOError, OSError):
+                    pass
 
+        # One handler per directory, however many files are in it
+        for directory, files in watched_files.items():
+            self.observer.schedule(
+                make_handler(files), directory, recursive=False)
+
+        self.debouncer.start()
         self.observer.start()
 
     def stop_watch(self):
@@ -614,15 +2345,17 @@ class Zenbu:
         Stop the file watcher.
         """
         self.observer.stop()
+        self.debouncer.stop()
 
     def join_watch(self):
         """
         Block until the file watcher exits.
         """
         self.observer.join()
+        self.debouncer.join()
 
 
-def parse_args():
+def parse_args(argv=None):
     parser = ArgumentParser(description=__doc__,
                             formatter_class=RawDescriptionHelpFormatter)
 
@@ -712,6 +2445,23 @@ def parse_args():
                         type=str,
                         default=None)
 
+    parser.add_argument('--watch-quiet',
+                        help="""
+                        seconds without changes to wait before rendering.
+                        Default: %s
+                        """ % WATCH_TIMEOUT,
+                        type=float,
+                        default=WATCH_TIMEOUT)
+
+    parser.add_argument('--watch-max-latency',
+                        help="""
+                        most seconds to delay rendering while changes
+                        keep coming.
+                        Default: %s
+                        """ % WATCH_MAX_LATENCY,
+                        type=float,
+                        default=WATCH_MAX_LATENCY)
+
     parser.add_argument('--diff',
                         help="""
                         show diff between template renderings and current
@@ -720,6 +2470,24 @@ def parse_args():
                         action='store_true',
                         default=False)
 
+    parser.add_argument('--check',
+                        help="""
+                        list destination files which differ from their
+                        template renderings, exiting with status 1 if any do,
+                        or 2 if any template could not be rendered
+                        """,
+                        action='store_true',
+                        default=False)
+
+    parser.add_argument('--diff-stat',
+                        help="""
+                        count changed lines per differing destination file,
+                        exiting with status 1 if any differ, or 2 if any
+                        template could not be rendered
+                        """,
+                        action='store_true',
+                        default=False)
+
     parser.add_argument('--dry',
                         help="""
                         do a dry run
@@ -727,24 +2495,422 @@ def parse_args():
                         action='store_true',
                         default=False)
 
+    parser.add_argument('-j', '--jobs',
+                        help="""
+                        number of processes to render with, 0 for one per CPU.
+                        Default: 1
+                        """,
+                        type=int,
+                        default=1)
+
+    parser.add_argument('--batch',
+                        help="""
+                        render into every destination listed in a YAML
+                        manifest, each with its own variable files
+                        """,
+                        type=str,
+                        default=None)
+
+    parser.add_argument('--stream',
+                        help="""
+                        write renders to disk as they are rendered, rather
+                        than holding each in memory
+                        """,
+                        action='store_true',
+                        default=False)
+
+    parser.add_argument('--fsync',
+                        help="""
+                        flush written files to disk before finishing
+                        """,
+                        action='store_true',
+                        default=False)
+
+    parser.add_argument('--link',
+                        help="""
+                        clone files which aren't templates into place
+                        copy-on-write instead of copying them, or hard link
+                        them where the filesystem can't, in which case
+                        editing either file in place edits both
+                        """,
+                        action='store_true',
+                        default=False)
+
+    parser.add_argument('--cache',
+                        help="""
+                        cache compiled templates and parsed YAML files
+                        in %s
+                        """ % ZENBU_CACHE,
+                        action='store_true',
+                        default=False)
+
+    parser.add_argument('--daemon',
+                        help="""
+                        keep templates warm for other commands, listening
+                        on %s
+                        """ % ZENBU_SOCKET,
+                        action='store_true',
+                        default=False)
+
+    parser.add_argument('--no-daemon',
+                        help="""
+                        run in this process even if a daemon is listening
+                        """,
+                        action='store_true',
+                        default=False)
+
+    parser.add_argument('--profile',
+                        help="""
+                        report the time spent in each phase of work and
+                        the %d slowest files, rendering in one process
+                        """ % PROFILE_TOP,
+                        action='store_true',
+                        default=False)
+
+    parser.add_argument('--profile-json',
+                        help="""
+                        write the time spent in each phase of work, overall
+                        and per file, to a JSON file
+                        """,
+                        type=str,
+                        default=None)
+
     parser.add_argument('variable_files',
                         help="additional variable files",
                         nargs='*',
                         type=str).completer = variable_set_completer
 
-    argcomplete.autocomplete(parser, always_complete_options=False)
-    return parser.parse_args()
+    parser.add_argument('--startup-report',
+                        help="""
+                        report startup time and heavy imports, failing if
+                        startup takes longer than %d ms
+                        """ % (STARTUP_BUDGET * 1000),
+                        action='store_true',
+                        default=False)
+
+    # Only import argcomplete when completing
+    if '_ARGCOMPLETE' in os.environ:
+        import argcomplete
+        argcomplete.autocomplete(parser, always_complete_options=False)
+    return parser.parse_args(argv)
 
 
-def main():
-    args = parse_args()
+def startup_report():
+    elapsed = time() - START_TIME
+    print("Startup took %.1f ms (budget %.1f ms)"
+          % (elapsed * 1000, STARTUP_BUDGET * 1000))
+    loaded = [m for m in HEAVY_MODULES if m in sys.modules]
+    print("Heavy modules loaded: %s" % (', '.join(loaded) or 'none'))
+    return elapsed <= STARTUP_BUDGET
 
-    # Set up logging
-    ch = logging.StreamHandler(sys.stdout)
-    ch.setLevel(logging.DEBUG)
-    ch.setFormatter(ColoredFormatter("%(log_color)s%(message)s"))
-    logger.addHandler(ch)
 
+def page(chunks, cmd, handler):
+    # Streams chunks of text to a pager as they are produced,
+    # along with anything logged to handler meanwhile
+    from subprocess import Popen, PIPE
+    pager = Popen(cmd, shell=True, stdin=PIPE, universal_newlines=True)
+    stream, handler.stream = handler.stream, pager.stdin
+    try:
+        for chunk in chunks:
+            pager.stdin.write(chunk)
+            pager.stdin.flush()
+        pager.stdin.close()
+    # The pager quit early
+    except (IOError, OSError, KeyboardInterrupt):
+        pass
+    finally:
+        handler.stream = stream
+
+    while True:
+        try:
+            pager.wait()
+            break
+        except KeyboardInterrupt:
+            pass
+
+
+def salted_cache_key(cache, name, filename=None):
+    # Filters applied to constants are run when compiling, so compiled
+    # templates are only good for the filters they were compiled with
+    from jinja2 import BytecodeCache
+    return BytecodeCache.get_cache_key(
+        cache, '%s\0%s' % (name, cache.salt), filename)
+
+
+def file_bytecode_cache(directory):
+    # A compiled template cache in a directory, kept across runs
+    from jinja2 import FileSystemBytecodeCache
+
+    class FileBytecodeCache(FileSystemBytecodeCache):
+        salt = ''  # Digest of the filters file
+        get_cache_key = salted_cache_key
+
+    return FileBytecodeCache(directory)
+
+
+def memory_bytecode_cache(buckets=None):
+    # A compiled template cache shared by every Zenbu in this process,
+    # starting with the compiled templates of another if given
+    from jinja2 import BytecodeCache
+
+    class MemoryBytecodeCache(BytecodeCache):
+        salt = ''  # Digest of the filters file
+        get_cache_key = salted_cache_key
+
+        def __init__(self):
+            self.buckets = dict(buckets or {})
+
+        def load_bytecode(self, bucket):
+            code = self.buckets.get(bucket.key)
+            if code:
+                bucket.bytecode_from_string(code)
+
+        def dump_bytecode(self, bucket):
+            self.buckets[bucket.key] = bucket.bytecode_to_string()
+
+        def clear(self):
+            self.buckets.clear()
+
+    return MemoryBytecodeCache()
+
+
+def build_zenbu(args, **kwargs):
+    # Builds a Zenbu from the command line arguments
+    return Zenbu(
+        args.template_dir,
+        args.dest_dir,
+        args.var_set_dir,
+        args.env_vars,
+        args.variable_files,
+        args.filters_file,
+        args.ignores_file,
+        args.watch_command,
+        set(args.watch_dirs.split(':')) if args.watch_dirs else None,
+        ZENBU_CACHE if args.cache else None,
+        args.jobs,
+        args.watch_quiet,
+        args.watch_max_latency,
+        fsync=args.fsync,
+        link=args.link,
+        stream=args.stream,
+        **kwargs)
+
+
+class MessageWriter(object):
+    """
+    A file-like object sending what is written to a daemon client.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+
+    def send(self, message):
+        self.stream.write(json.dumps(message).encode('utf-8') + b'\n')
+        self.stream.flush()
+
+    def write(self, text):
+        self.send({'out': text})
+
+    def flush(self):
+        pass
+
+
+class Daemon(object):
+    """
+    Runs commands sent over a socket with warm Zenbus.
+    """
+    def __init__(self, path, handler, size=DAEMON_INSTANCES):
+        from collections import OrderedDict
+        self.path = path
+        self.handler = handler
+        self.size = size                # Most Zenbus to keep
+        self.zenbus = OrderedDict()     # Arguments -> Zenbu, oldest first
+        self.bytecode_cache = memory_bytecode_cache()
+
+    def zenbu(self, args, environ):
+        """
+        Get an up to date Zenbu for the arguments.
+        """
+        key = json.dumps([args.template_dir, args.dest_dir,
+                          args.var_set_dir, args.env_vars,
+                          args.variable_files, args.filters_file,
+                          args.ignores_file, args.cache, args.jobs,
+                          args.fsync, args.link, args.stream])
+        zenbu = self.zenbus.pop(key, None)
+        if zenbu:
+            zenbu.environ = zenbu.options['environ'] = environ
+            zenbu.refresh()
+            # Nothing watched for new or removed templates
+            zenbu.index = None
+        else:
+            zenbu = build_zenbu(args, environ=environ,
+                                bytecode_cache=self.bytecode_cache)
+        self.zenbus[key] = zenbu
+        while len(self.zenbus) > self.size:
+            self.zenbus.popitem(last=False)
+        return zenbu
+
+    def handle(self, conn):
+        """
+        Run one client's command, sending back its output and status.
+        """
+        from argparse import Namespace
+        stream = conn.makefile('rwb')
+        line = stream.readline()
+        if not line:
+            return  # Only checking whether we are up
+        request = json.loads(line.decode('utf-8'))
+        args = Namespace(**request['args'])
+        writer = MessageWriter(stream)
+
+        stdout, sys.stdout = sys.stdout, writer
+        log, self.handler.stream = self.handler.stream, writer
+        try:
+            status = run(args, self.handler, pager=None,
+                         make_zenbu=lambda args, **kwargs: self.zenbu(
+                             args, request['environ']))
+        except Exception as e:
+            logger.critical("Daemon error: %s" % e)
+            status = 1
+        finally:
+            sys.stdout = stdout
+            self.handler.stream = log
+        writer.send({'exit': status})
+
+    def serve(self):
+        """
+        Serve clients until interrupted.
+        """
+        import socket
+        if run_in_daemon(None, self.handler, self.path,
+                         probe=True) is not None:
+            logger.critical("A daemon is already listening on %s"
+                            % self.path)
+            return 1
+
+        # Only listen where nobody else can listen or connect instead
+        directory = os.path.dirname(self.path)
+        try:
+            os.mkdir(directory, 0o700)
+        except (IOError, OSError):
+            pass
+        if not owns_path(directory, directory=True):
+            logger.critical("Not listening in %s, which others can write to"
+                            % directory)
+            return 1
+        if os.path.lexists(self.path):
+            if not owns_path(self.path):
+                logger.critical("Not replacing %s, which isn't our socket"
+                                % self.path)
+                return 1
+            os.remove(self.path)
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o077)
+        try:
+            server.bind(self.path)
+        finally:
+            os.umask(umask)
+        server.listen(5)
+        logger.info("Listening on %s" % self.path)
+
+        try:
+            while True:
+                conn = server.accept()[0]
+                try:
+                    self.handle(conn)
+                except (IOError, OSError, ValueError) as e:
+                    logger.error("Lost client: %s" % e)
+                finally:
+                    conn.close()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            os.remove(self.path)
+        return 0
+
+
+def owns_path(path, directory=False):
+    # Whether a path is our own socket, or our own directory which
+    # nobody else can write to, without following symlinks
+    import stat
+    try:
+        st = os.lstat(path)
+    except (IOError, OSError):
+        return False
+    if st.st_uid != os.getuid():
+        return False
+    if directory:
+        return stat.S_ISDIR(st.st_mode) and not st.st_mode & 0o022
+    return stat.S_ISSOCK(st.st_mode)
+
+
+def run_in_daemon(args, handler, path=ZENBU_SOCKET, probe=False):
+    # Runs a command in the daemon, returning its exit status,
+    # or None if no daemon is listening
+    if not os.path.lexists(path):
+        return None
+    # Our variables and environment are only for our own daemon
+    if not owns_path(path) or \
+            not owns_path(os.path.dirname(path), directory=True):
+        logger.warning("Ignoring %s, which isn't our own daemon's socket"
+                       % path)
+        return None
+    import socket
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+    except (IOError, OSError):
+        client.close()
+        return None
+    if probe:
+        client.close()
+        return 0
+
+    # The daemon has its own working directory and environment
+    request = dict(vars(args))
+    for key in ('template_dir', 'dest_dir', 'var_set_dir',
+                'filters_file', 'ignores_file'):
+        request[key] = os.path.abspath(request[key])
+    if args.batch:
+        request['batch'] = os.path.abspath(args.batch)
+    request['variable_files'] = [
+        os.path.abspath(name) if os.path.exists(name) else name
+        for name in args.variable_files]
+
+    stream = client.makefile('rwb')
+    status = [1]  # Unless the daemon says otherwise
+
+    def output():
+        for line in stream:
+            message = json.loads(line.decode('utf-8'))
+            if 'exit' in message:
+                status[0] = message['exit']
+                return
+            yield message['out']
+
+    try:
+        stream.write(json.dumps({
+            'args': request,
+            'environ': dict(os.environ) if args.env_vars else None,
+        }).encode('utf-8') + b'\n')
+        stream.flush()
+
+        if args.diff:
+            page(output(), 'less -R', handler)
+        else:
+            for text in output():
+                sys.stdout.write(text)
+                sys.stdout.flush()
+    except (IOError, OSError, ValueError) as e:
+        logger.critical("Lost daemon: %s" % e)
+    finally:
+        client.close()
+    return status[0]
+
+
+def run(args, handler, pager='less -R', make_zenbu=build_zenbu):
+    # Runs a command, returning its exit status
     # Defaults on files
     if args.list_var_sets:
         args.variable_files = []
@@ -769,40 +2935,75 @@ def main():
                     % args.ignores_file)
         args.ignores_file = None
 
-    try:
-        zenbu = Zenbu(
-            args.template_dir,
-            args.dest_dir,
-            args.var_set_dir,
-            args.env_vars,
-            args.variable_files,
-            args.filters_file,
-            args.ignores_file,
-            args.watch_command,
-            set(args.watch_dirs.split(':')) if args.watch_dirs else None)
-    except (NotFoundError, ParseError) as e:
-        logger.critical(e)
-        sys.exit(1)
-
-    # -l
+    # -l, which needs no templates
     if args.list_var_sets:
+        if not args.var_set_dir:
+            logger.critical("No variable set path to list from.")
+            return 1
         try:
-            for var_set in zenbu.var_sets:
+            for var_set in cached_var_sets(args.var_set_dir,
+                                           args.ignores_file):
                 print(var_set)
-        except ValueError as e:
+        except ParseError as e:
             logger.critical(e)
-            sys.exit(1)
+            return 1
+        return 0
+
+    # --profile
+    profiling = args.profile or args.profile_json
+    profiler = Profiler() if profiling else NullProfiler()
 
+    try:
+        with profiler.phase('total'):
+            zenbu = make_zenbu(args, profiler=profiler)
+            status = run_mode(zenbu, args, handler, pager)
+    except (NotFoundError, ParseError) as e:
+        logger.critical(e)
+        return 1
+
+    if args.profile:
+        print(profiler.report())
+    if args.profile_json:
+        with open(args.profile_json, 'w') as f:
+            json.dump(profiler.to_json(), f, indent=2, sort_keys=True)
+    return status
+
+
+def run_mode(zenbu, args, handler, pager):
+    # Runs what the arguments ask of a Zenbu, returning the exit status
     # --diff
-    elif args.diff:
-        pipepager(
-            ''.join(
-                ''.join(
-                    diff_colorify(line) for line in diff
-                ) for diff in zenbu.diff()
-            ),
-            cmd='less -R',
-        )
+    if args.diff:
+        diffs = (''.join(diff_colorify(line) for line in diff)
+                 for diff in zenbu.diff())
+        if pager:
+            page(diffs, pager, handler)
+        else:
+            for diff in diffs:
+                sys.stdout.write(diff)
+
+    # --check
+    elif args.check:
+        drifted = False
+        for _, dest, _ in zenbu.drift():
+            print(dest)
+            drifted = True
+        if zenbu.render_errors:
+            return 2
+        return 1 if drifted else 0
+
+    # --diff-stat
+    elif args.diff_stat:
+        files = total_added = total_removed = 0
+        for dest, added, removed in zenbu.diff_stat():
+            print("%s | +%d -%d" % (dest, added, removed))
+            files += 1
+            total_added += added
+            total_removed += removed
+        print("%d files changed, %d insertions(+), %d deletions(-)"
+              % (files, total_added, total_removed))
+        if zenbu.render_errors:
+            return 2
+        return 1 if files else 0
 
     # --dry
     elif args.dry:
@@ -810,6 +3011,11 @@ def main():
         for _, dest, _ in zenbu.render():
             logger.info("Successfully dry rendered \"%s\"" % dest)
 
+    # --batch
+    elif args.batch:
+        results = zenbu.batch(load_batch(args.batch))
+        return 1 if any(counts is None for _, counts in results) else 0
+
     # -w
     elif args.watch:
         logger.info("Starting watch...")
@@ -824,6 +3030,36 @@ def main():
     # Default mode: render and write
     else:
         zenbu.render_and_write()
+    return 0
+
+
+def main():
+    args = parse_args()
+
+    # --startup-report
+    if args.startup_report:
+        sys.exit(0 if startup_report() else 1)
+
+    from colorlog import ColoredFormatter
+
+    # Set up logging
+    ch = logging.StreamHandler(sys.stdout)
+    ch.setLevel(logging.DEBUG)
+    ch.setFormatter(ColoredFormatter("%(log_color)s%(message)s"))
+    logger.addHandler(ch)
+
+    # --daemon
+    if args.daemon:
+        sys.exit(Daemon(ZENBU_SOCKET, ch).serve())
+
+    # Let a running daemon do the work, if there is one
+    if not (args.watch or args.no_daemon or args.profile or
+            args.profile_json):
+        status = run_in_daemon(args, ch)
+        if status is not None:
+            sys.exit(status)
+
+    sys.exit(run(args, ch))
 
 
 if __name__ == '__main__':